@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Series level summary tables, updated as each episode is processed.
+
+Three tables are kept for each series in its dv-data directory:
+
+    <series>-presence   faces and frames of each character in each shot
+    <series>-screen     screen time of each character in each episode
+    <series>-shotlen    shot length statistics of each episode
+
+An EpisodeAggregator collects the counts of one episode from the frame
+and faces tables, chunk by chunk when the episode is streamed. The rows of
+the episode are then written into the series tables, replacing any rows
+from an earlier run, so the tables never require re-reading the
+per-episode output.
+"""
+import os
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from tables import FORMATS, read_table, write_table
+from utils import file_lock, get_series_paths
+
+AGGREGATES = ['presence', 'screen', 'shotlen']
+
+PRESENCE_COLUMNS = ["video", "sid", "character", "frames", "faces"]
+SCREEN_COLUMNS = ["video", "character", "shots", "frames", "seconds"]
+SHOTLEN_COLUMNS = ["video", "shots", "frames", "mean", "median", "std",
+                   "min", "max", "mean_seconds"]
+
+
+class EpisodeAggregator():
+    """Collect the series level summaries of a single episode.
+
+    Rows of the frame and faces tables are passed to 'add', either all at
+    once or in chunks; a shot may span several chunks, but each frame
+    must be contained in a single chunk.
+    """
+    def __init__(self):
+        self._shots = []
+        self._presence = []
+        self._frames = []
+        self._face_frames = []
+
+    def add(self, frame, faces):
+        """Add the counts from a chunk of the frame and faces tables.
+        """
+        self._shots.append(frame.groupby('sid').size())
+        self._presence.append(faces.groupby(['sid', 'character']).agg(
+            frames=('frame', 'nunique'), faces=('frame', 'size')))
+        self._frames.append(frame[['frame', 'dval']])
+        self._face_frames.append(
+            faces[['frame', 'sid', 'character']].drop_duplicates())
+
+    def get_presence(self, video):
+        """Return the number of frames and faces of each character per shot.
+        """
+        presence = pd.DataFrame(columns=PRESENCE_COLUMNS[1:])
+        if self._presence:
+            presence = pd.concat([x.reset_index() for x in self._presence],
+                                 ignore_index=True)
+        presence = presence.groupby(['sid', 'character'], as_index=False)[
+            ['frames', 'faces']].sum()
+        presence.insert(0, 'video', video)
+
+        return presence.reindex(columns=PRESENCE_COLUMNS)
+
+    def _shot_lengths(self):
+        # number of frames in each shot, indexed by shot id
+        if not self._shots:
+            return pd.Series([], dtype=np.int64)
+        return pd.concat(self._shots).groupby(level=0).sum()
+
+    def _frame_weights(self, sampling):
+        # number of frames that each frame searched for faces stands for,
+        # i.e., the distance to the next frame that was searched
+        frames = pd.concat(self._frames, ignore_index=True) if \
+            self._frames else pd.DataFrame({'frame': [], 'dval': []})
+        numbers = frames['frame'].values.astype(np.int64)
+        face = (sampling or {}).get('face', {})
+        if not face or face.get('propagated') or not len(numbers):
+            return pd.Series(1.0, index=numbers)
+
+        # script03 restarts the stride at the start of each chunk
+        starts = np.asarray(face.get('chunk_starts') or [0])
+        offset = numbers - starts[np.searchsorted(starts, numbers,
+                                                  side='right') - 1]
+        sampled = offset == 0
+        if face.get('stride', 1) > 0:
+            sampled |= offset % face.get('stride', 1) == 0
+        if face.get('dval_cut') is not None:
+            sampled |= frames['dval'].values > face['dval_cut']
+
+        searched = np.sort(numbers[sampled])
+        stops = np.append(searched[1:], numbers.max() + 1)
+        return pd.Series((stops - searched).astype(np.float64),
+                         index=searched)
+
+    def get_screen(self, video, fps, sampling=None):
+        """Return the screen time of each character in the episode.
+
+        When faces were only detected on some of the frames, each frame
+        with a face stands for the frames up to the next frame that was
+        searched for faces, as given by the sampling recorded by script03.
+        """
+        faces = pd.DataFrame(columns=['frame', 'sid', 'character'])
+        if self._face_frames:
+            faces = pd.concat(self._face_frames, ignore_index=True)
+        weights = self._frame_weights(sampling)
+
+        screen = faces.assign(time=weights.reindex(
+            faces['frame'].values).fillna(1).values)
+        screen = screen.groupby('character').agg(
+            shots=('sid', 'nunique'), frames=('frame', 'size'),
+            seconds=('time', 'sum')).reset_index()
+        screen['seconds'] = screen['seconds'] / fps
+        screen.insert(0, 'video', video)
+
+        return screen.reindex(columns=SCREEN_COLUMNS)
+
+    def get_shotlen(self, video, fps):
+        """Return the shot length statistics of the episode, in frames.
+        """
+        lengths = self._shot_lengths().values
+
+        stats = {'video': video, 'shots': len(lengths),
+                 'frames': int(lengths.sum())}
+        if len(lengths):
+            stats.update(mean=lengths.mean(), median=np.median(lengths),
+                         std=lengths.std(), min=lengths.min(),
+                         max=lengths.max())
+            stats['mean_seconds'] = stats['mean'] / fps
+
+        return pd.DataFrame([stats]).reindex(columns=SHOTLEN_COLUMNS)
+
+    def get_tables(self, video, fps, sampling=None):
+        """Return a dictionary of the summary tables, keyed by AGGREGATES.
+
+        Args:
+            video: name of the video, as in the 'video' column.
+            fps: frame rate of the video, used to convert frames to seconds.
+            sampling: the face sampling recorded by script03, if any, as
+                from JsonProcessor.get_sampling.
+        Returns:
+            a dictionary of pandas DataFrame objects.
+        """
+        return {'presence': self.get_presence(video),
+                'screen': self.get_screen(video, fps, sampling),
+                'shotlen': self.get_shotlen(video, fps)}
+
+
+def get_aggregate_path(series, name, fmt="csv"):
+    """Return the path of a series level summary table.
+    """
+    paths = get_series_paths(series)
+    return join(paths['opath'], series + "-" + name + FORMATS[fmt])
+
+
+def update_aggregates(series, tables, fmt="csv"):
+    """Replace the rows of one episode in the series level tables.
+
+    Each table is read, updated and atomically replaced while holding a
+    lock, so that several worker processes may update the same series.
+
+    Args:
+        series: string describing the series.
+        tables: dictionary of summary tables, as from get_tables.
+        fmt: file format of the tables; one of the keys of FORMATS.
+    Returns:
+        None
+    """
+    for name, dframe in tables.items():
+        path = get_aggregate_path(series, name, fmt)
+        with file_lock(path):
+            if os.path.isfile(path):
+                old = read_table(path, fmt)
+                old = old[~old['video'].isin(dframe['video'])]
+                dframe = pd.concat([old, dframe], ignore_index=True)
+
+            dframe = dframe.sort_values('video', kind='stable')
+            tmp_path = path + ".tmp"
+            write_table(dframe, tmp_path, fmt)
+            os.replace(tmp_path, path)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the pipeline on synthetic dvt episodes.
+
+This callable module generates synthetic dvt jsonl files and srt files
+in a temporary directory and times the main processing steps over
+episodes of several sizes: JsonProcessor (in memory and streaming),
+conversion to the binary store, vectorized shot detection, subtitle
+parsing, table writing in each output format, and building a
+fingerprint with get_fprint. No video files or GPU are needed.
+
+Example:
+    To time episodes of 5000 and 20000 frames and save the results as a
+    baseline, and later compare a new run against it, we would run:
+
+        $ python3 bench_pipeline.py --frames 5000 20000 \
+                                    --save-baseline bench_baseline.json
+        $ python3 bench_pipeline.py --frames 5000 20000 \
+                                    --baseline bench_baseline.json
+"""
+import argparse
+import json
+import os
+from os.path import join
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def make_episode(path, frames, faces=0.5, embed_size=128, objects=0.0,
+                 seed=0):
+    """Write a synthetic dvt jsonl file.
+
+    Args:
+        path: string describing the path of the output file.
+        frames: number of frames in the episode.
+        faces: average number of faces per frame.
+        embed_size: length of each face embedding.
+        objects: average number of objects per frame.
+        seed: seed of the random number generator.
+    Returns:
+        None
+    """
+    rng = random.Random(seed)
+    video = os.path.basename(path).replace("-dvt.jsonl", ".mp4")
+    hist = [rng.randint(0, 9000) for _ in range(48)]
+
+    with open(path, "w") as fout:
+        fout.write(json.dumps({'type': "video", 'video': video, 'fps': 29.97,
+                               'frames': frames, 'width': 640,
+                               'height': 480}) + "\n")
+        for frame in range(frames):
+            # start a new synthetic shot roughly every 100 frames
+            new_shot = rng.random() < 0.01
+            if new_shot:
+                hist = [rng.randint(0, 90000) for _ in range(48)]
+            line = {'type': "frame", 'frame': frame, 'hist': {'hsv': hist}}
+            if frame > 0:
+                level = 30 if new_shot else 3
+                line['diff'] = {'decile': sorted(
+                    rng.randint(0, level) for _ in range(11))}
+
+            nfaces = int(faces) + (rng.random() < faces - int(faces))
+            if nfaces:
+                line['face'] = [{
+                    'embed': [round(rng.gauss(0, 1), 6)
+                              for _ in range(embed_size)],
+                    'box': {'top': 10, 'bottom': 90, 'left': 20,
+                            'right': 80},
+                    'hog_overlap': rng.random() < 0.5}
+                                for _ in range(nfaces)]
+
+            nobjects = int(objects) + (rng.random() < objects - int(objects))
+            if nobjects:
+                line['object'] = [{
+                    'class': rng.choice(["person", "chair", "cup"]),
+                    'box': {'top': 5, 'bottom': 50, 'left': 5, 'right': 50},
+                    'score': round(rng.random(), 4)}
+                                  for _ in range(nobjects)]
+
+            fout.write(json.dumps(line) + "\n")
+
+
+def make_srt(path, cues, seed=0):
+    """Write a synthetic srt file with the given number of cues.
+    """
+    rng = random.Random(seed)
+    words = ["well", "samantha", "darling", "what", "is", "<i>this</i>",
+             "about", "the", "house", "tonight"]
+
+    def stamp(msec):
+        return "{0:02d}:{1:02d}:{2:02d},{3:03d}".format(
+            msec // 3600000, msec // 60000 % 60, msec // 1000 % 60,
+            msec % 1000)
+
+    with open(path, "w") as fout:
+        start = 0
+        for num in range(1, cues + 1):
+            end = start + rng.randint(800, 4000)
+            text = " ".join(rng.choice(words) for _ in range(8))
+            fout.write("{0:d}\n{1:s} --> {2:s}\n{3:s}\n{4:s}\n\n".format(
+                num, stamp(start), stamp(end), text[:30], text[30:]))
+            start = end + rng.randint(0, 500)
+
+
+def make_fprint(characters=6, embed_size=128, seed=0):
+    """Return a synthetic fingerprint dictionary.
+    """
+    rng = np.random.RandomState(seed)
+    return {"char{0:d}".format(x): rng.normal(size=embed_size)
+            for x in range(characters)}
+
+
+def measure(func, setup=None):
+    """Call func, returning its wall time in seconds and peak memory in MB.
+
+    Peak memory is the largest amount of memory allocated through Python
+    (including numpy arrays) while the function runs. Since tracing slows
+    down pure Python code far more than numpy code, the function is called
+    twice: once untraced for the time and once traced for the memory.
+    'setup', when given, is called before each call, e.g., to remove the
+    output of the first call.
+    """
+    if setup is not None:
+        setup()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak / 2**20
+
+
+def run_benchmarks(tmpdir, sizes, args):
+    """Run every benchmark at every size, returning a list of results.
+    """
+    from dvtstore import write_store
+    from script05_process_json import JsonProcessor, get_shots, \
+        get_subtitles, write_chunks
+    from tables import FORMATS, write_table
+
+    fprint = make_fprint(args.characters, args.embed_size)
+    results = []
+
+    def record(name, size, items, func, setup=None):
+        seconds, peak = measure(func, setup)
+        results.append({'name': name, 'size': size, 'seconds': seconds,
+                        'items_per_sec': items / seconds if seconds else 0,
+                        'peak_mb': peak})
+        print("{0:<22s} {1:>8d} {2:>10.3f} {3:>12.0f} {4:>10.1f}".format(
+            name, size, seconds, results[-1]['items_per_sec'], peak))
+        sys.stdout.flush()
+
+    print("{0:<22s} {1:>8s} {2:>10s} {3:>12s} {4:>10s}".format(
+        "benchmark", "size", "seconds", "items/sec", "peak MB"))
+    for size in sizes:
+        jpath = join(tmpdir, "bench-s01-e{0:02d}-dvt.jsonl".format(
+            sizes.index(size) + 1))
+        make_episode(jpath, size, faces=args.faces,
+                     embed_size=args.embed_size, objects=args.objects)
+
+        record("json_load", size, size,
+               lambda: JsonProcessor(jpath, fprint).get_data())
+        opaths = [join(tmpdir, x + ".csv")
+                  for x in ["frame", "shots", "faces", "yolos"]]
+        record("json_stream", size, size, lambda: write_chunks(
+            JsonProcessor(jpath, fprint, stream=True), opaths,
+            chunk_size=args.chunk_size))
+
+        spath = [None]
+        record("store_write", size, size,
+               lambda: spath.__setitem__(0, write_store(jpath)))
+        record("store_load", size, size,
+               lambda: JsonProcessor(spath[0], fprint).get_data())
+        record("shots_json", size, size, lambda: get_shots(jpath))
+        record("shots_store", size, size, lambda: get_shots(spath[0]))
+
+        frame = JsonProcessor(jpath, fprint).get_data()[1]
+        for fmt in sorted(FORMATS):
+            opath = join(tmpdir, "frame" + FORMATS[fmt])
+            record("write_" + fmt, size, size,
+                   lambda: write_table(frame, opath, fmt))
+
+        cues = max(size // 30, 1)
+        srt_path = join(tmpdir, "bench.srt")
+        make_srt(srt_path, cues)
+        record("subtitles", cues, cues,
+               lambda: get_subtitles("bench-s01-e01", srt_path))
+
+    if args.fprint:
+        results.extend(bench_fprint(tmpdir, args, record))
+
+    return results
+
+
+def bench_fprint(tmpdir, args, record):
+    """Time get_fprint on a synthetic episode at the expected location.
+
+    get_fprint reads exemplar lines of "idoj-s02-e02", so a synthetic
+    episode with a face on every frame is written in a temporary base
+    path and the parameter file is pointed at it.
+    """
+    base = join(tmpdir, "base")
+    os.makedirs(join(base, "stage", "idoj"), exist_ok=True)
+    os.makedirs(join(base, "model", "fprint"), exist_ok=True)
+    with open(join(tmpdir, "params.json"), "w") as fout:
+        json.dump({'basepath': base}, fout)
+    make_episode(join(base, "stage", "idoj", "idoj-s02-e02-dvt.jsonl"),
+                 15400, faces=1, embed_size=args.embed_size)
+
+    from script04_fingerprint import get_fprint, get_fprint_path
+    from utils import PARAMS_ENV
+
+    def remove_fprint():
+        # get_fprint only loads the file once it exists
+        if os.path.exists(get_fprint_path("idoj")):
+            os.remove(get_fprint_path("idoj"))
+
+    old_params = os.environ.get(PARAMS_ENV)
+    os.environ[PARAMS_ENV] = join(tmpdir, "params.json")
+    try:
+        record("fprint", 15400, 4, lambda: get_fprint("idoj"),
+               remove_fprint)
+    finally:
+        if old_params is None:
+            del os.environ[PARAMS_ENV]
+        else:
+            os.environ[PARAMS_ENV] = old_params
+
+    return []
+
+
+def compare(results, baseline, tolerance):
+    """Compare results against a baseline, returning the regressions.
+    """
+    old = {(x['name'], x['size']): x for x in baseline}
+    regressions = []
+
+    print("\n{0:<22s} {1:>8s} {2:>10s} {3:>10s} {4:>8s}".format(
+        "benchmark", "size", "baseline", "current", "ratio"))
+    for res in results:
+        base = old.get((res['name'], res['size']))
+        if base is None or not base['seconds']:
+            continue
+        ratio = res['seconds'] / base['seconds']
+        flag = ""
+        if ratio > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(res)
+        print("{0:<22s} {1:>8d} {2:>10.3f} {3:>10.3f} {4:>8.2f}{5:s}".format(
+            res['name'], res['size'], base['seconds'], res['seconds'], ratio,
+            flag))
+
+    return regressions
+
+
+def get_args():
+    """Return the argument parser for this script.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline on synthetic episodes.')
+    parser.add_argument('--frames', dest='frames', nargs='+', type=int,
+                        default=[2000, 10000],
+                        help='frame counts of the synthetic episodes')
+    parser.add_argument('--faces', dest='faces', type=float, default=0.5,
+                        help='average number of faces per frame')
+    parser.add_argument('--objects', dest='objects', type=float, default=0.1,
+                        help='average number of objects per frame')
+    parser.add_argument('--embed-size', dest='embed_size', type=int,
+                        default=128, help='length of the face embeddings')
+    parser.add_argument('--characters', dest='characters', type=int,
+                        default=6, help='number of fingerprint characters')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        default=5000, help='chunk size in streaming mode')
+    parser.add_argument('--no-fprint', dest='fprint', action='store_false',
+                        help='skip the get_fprint benchmark')
+    parser.add_argument('--baseline', dest='baseline', default=None,
+                        help='json file of results to compare against')
+    parser.add_argument('--tolerance', dest='tolerance', type=float,
+                        default=1.25,
+                        help='slowdown ratio reported as a regression')
+    parser.add_argument('--save-baseline', dest='save_baseline',
+                        default=None,
+                        help='json file in which to save the results')
+
+    return parser.parse_args()
+
+
+def run_bench():
+    """Run the module with the selected user arguments.
+    """
+    args = get_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = run_benchmarks(tmpdir, sorted(args.frames), args)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fout:
+            json.dump(results, fout, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r") as fin:
+            baseline = json.load(fin)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_bench()
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""Compact binary store for dvt annotations.
+
+The jsonl files written by the distant viewing toolkit keep every number
+as text. This module converts them into a directory of fixed-dtype numpy
+arrays that can be memory mapped, so readers never parse floats:
+
+    meta.json           the video line, object class names and line count
+    line.npy            line number of each frame in the original jsonl
+    frame.npy           frame number
+    hist.npy            HSV histogram, one row per frame
+    diff.npy            diff deciles, one row per frame (zero when missing)
+    has_diff.npy        whether the frame has a diff annotation
+    face_offset.npy     offsets into the face arrays (length frames + 1)
+    face_embed.npy      face embeddings, one row per face
+    face_box.npy        top, bottom, left, right of each face
+    face_overlap.npy    hog overlap of each face
+    object_offset.npy   offsets into the object arrays (length frames + 1)
+    object_box.npy      top, bottom, left, right of each object
+    object_score.npy    score of each object
+    object_class.npy    index of each object's class in meta.json
+
+The faces of frame i are rows face_offset[i]:face_offset[i + 1] of the
+face arrays, and likewise for objects. The file meta.json is written last
+and marks a complete store.
+"""
+import json
+import os
+from os.path import join
+import shutil
+
+import numpy as np
+
+from utils import IndexedJsonl, iter_jsonl
+
+STORE_VERSION = 1
+BOX_KEYS = ['top', 'bottom', 'left', 'right']
+
+
+def get_store_path(json_file):
+    """Return the path of the store corresponding to a jsonl file.
+    """
+    return os.path.splitext(json_file)[0] + ".store"
+
+
+def get_sampling_path(path):
+    """Return the path of the frame sampling file of a jsonl file or store.
+
+    script03 writes this file when an annotator only saw some of the
+    frames; a jsonl file and its store share the same sampling file.
+    """
+    return os.path.splitext(path)[0] + ".sampling.json"
+
+
+def read_sampling(path):
+    """Return the frame sampling of a dvt jsonl file or store, if any.
+    """
+    sampling_path = get_sampling_path(path)
+    if not os.path.isfile(sampling_path):
+        return None
+
+    with open(sampling_path, "r") as fin:
+        return json.load(fin)
+
+
+def _compact(values, width=None):
+    """Stack values into an array using 32-bit integers or floats.
+    """
+    if width is not None and not values:
+        return np.zeros((0, width), dtype=np.float32)
+
+    arr = np.asarray(values)
+    if np.issubdtype(arr.dtype, np.integer):
+        return arr.astype(np.int32)
+    if np.issubdtype(arr.dtype, np.floating):
+        return arr.astype(np.float32)
+
+    return arr
+
+
+def write_store(json_file, store_path=None):
+    """Convert a dvt jsonl file into a binary store.
+
+    Args:
+        json_file: string describing the path to the jsonl file.
+        store_path: path of the output directory; by default the jsonl
+            path with the extension replaced by ".store".
+    Returns:
+        the path of the store.
+    """
+    if store_path is None:
+        store_path = get_store_path(json_file)
+
+    meta = {'version': STORE_VERSION, 'video': None, 'video_line': None}
+    cols = {key: [] for key in ['line', 'frame', 'hist', 'diff',
+                                'face_embed', 'face_box', 'face_overlap',
+                                'object_box', 'object_score',
+                                'object_class']}
+    nfaces = [0]
+    nobjects = [0]
+    classes = {}
+    diff_size = 0
+
+    nlines = 0
+    for nlines, line in enumerate(iter_jsonl(json_file), start=1):
+        if line['type'] == "video":
+            meta['video'] = line
+            meta['video_line'] = nlines - 1
+        if line['type'] != "frame":
+            continue
+
+        cols['line'].append(nlines - 1)
+        cols['frame'].append(line['frame'])
+        cols['hist'].append(line['hist']['hsv'])
+        if 'diff' in line:
+            cols['diff'].append(line['diff']['decile'])
+            diff_size = len(line['diff']['decile'])
+        else:
+            cols['diff'].append(None)
+
+        for face in line.get('face', []):
+            cols['face_embed'].append(np.asarray(face['embed'],
+                                                 dtype=np.float32))
+            cols['face_box'].append([face['box'][x] for x in BOX_KEYS])
+            cols['face_overlap'].append(face['hog_overlap'])
+        nfaces.append(len(cols['face_box']))
+
+        for obj in line.get('object', []):
+            cols['object_box'].append([obj['box'][x] for x in BOX_KEYS])
+            cols['object_score'].append(obj['score'])
+            cols['object_class'].append(
+                classes.setdefault(obj['class'], len(classes)))
+        nobjects.append(len(cols['object_box']))
+
+    # frames without a diff annotation are stored as a row of zeros
+    has_diff = [x is not None for x in cols['diff']]
+    cols['diff'] = [[0] * diff_size if x is None else x for x in cols['diff']]
+
+    arrays = {
+        'line': np.asarray(cols['line'], dtype=np.int64),
+        'frame': np.asarray(cols['frame'], dtype=np.int64),
+        'hist': _compact(cols['hist'], width=0),
+        'diff': _compact(cols['diff'], width=diff_size).reshape(
+            (len(cols['frame']), diff_size)),
+        'has_diff': np.asarray(has_diff, dtype=bool),
+        'face_offset': np.asarray(nfaces, dtype=np.int64),
+        'face_embed': _compact(cols['face_embed'], width=0),
+        'face_box': _compact(cols['face_box'], width=4),
+        'face_overlap': np.asarray(cols['face_overlap']),
+        'object_offset': np.asarray(nobjects, dtype=np.int64),
+        'object_box': _compact(cols['object_box'], width=4),
+        'object_score': np.asarray(cols['object_score'], dtype=np.float32),
+        'object_class': np.asarray(cols['object_class'], dtype=np.int32)
+    }
+    meta['classes'] = sorted(classes, key=classes.get)
+    meta['lines'] = nlines
+
+    # write into a temporary directory and move it into place when done
+    tmp_path = store_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for key, arr in arrays.items():
+        np.save(join(tmp_path, key + ".npy"), arr)
+    with open(join(tmp_path, "meta.json"), "w") as fout:
+        json.dump(meta, fout)
+
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.replace(tmp_path, store_path)
+
+    return store_path
+
+
+class DvtStore():
+    """Read a binary store of dvt annotations.
+
+    The arrays are memory mapped on first access, so opening a store is
+    cheap and only the pages that are used are read from disk. Indexing
+    the store with a line number of the original jsonl file returns a
+    dictionary with the same structure as that line.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(join(path, "meta.json"), "r") as fin:
+            self.meta = json.load(fin)
+        self._arrays = {}
+
+    def __getattr__(self, key):
+        if key.startswith("_") or not os.path.isfile(
+                join(self.path, key + ".npy")):
+            raise AttributeError(key)
+
+        if key not in self._arrays:
+            self._arrays[key] = np.load(join(self.path, key + ".npy"),
+                                        mmap_mode='r')
+        return self._arrays[key]
+
+    def __len__(self):
+        return self.meta['lines']
+
+    def __getitem__(self, lineno):
+        if lineno == self.meta['video_line']:
+            return self.meta['video']
+
+        row = np.searchsorted(self.line, lineno)
+        if row == len(self.line) or self.line[row] != lineno:
+            raise IndexError("line {0:d} is not a frame".format(lineno))
+
+        return self.frame_line(row)
+
+    def frame_line(self, row):
+        """Return a dictionary describing the frame stored in a given row.
+        """
+        line = {'type': "frame", 'frame': int(self.frame[row]),
+                'hist': {'hsv': self.hist[row]}}
+        if self.has_diff[row]:
+            line['diff'] = {'decile': self.diff[row]}
+
+        start, stop = self.face_offset[row], self.face_offset[row + 1]
+        if stop > start:
+            line['face'] = [
+                {'embed': self.face_embed[idx],
+                 'box': dict(zip(BOX_KEYS, self.face_box[idx].tolist())),
+                 'hog_overlap': self.face_overlap[idx].item()}
+                for idx in range(start, stop)]
+
+        start, stop = self.object_offset[row], self.object_offset[row + 1]
+        if stop > start:
+            line['object'] = [
+                {'class': self.meta['classes'][self.object_class[idx]],
+                 'box': dict(zip(BOX_KEYS, self.object_box[idx].tolist())),
+                 'score': self.object_score[idx].item()}
+                for idx in range(start, stop)]
+
+        return line
+
+    def iter_lines(self):
+        """Iterate over the video line and every frame line in order.
+        """
+        if self.meta['video'] is not None:
+            yield self.meta['video']
+
+        for row in range(len(self.frame)):
+            yield self.frame_line(row)
+
+
+def iter_dvt(path):
+    """Iterate over the lines of a dvt jsonl file or binary store.
+    """
+    if os.path.isdir(path):
+        return DvtStore(path).iter_lines()
+
+    return iter_jsonl(path)
+
+
+def load_dvt(json_file):
+    """Return an indexable collection of the lines of a dvt jsonl file.
+
+    The binary store next to the jsonl file is used when it exists, and
+    otherwise the lines are read through the jsonl offset index. Either
+    way individual lines are read without parsing the whole file.
+    """
+    store_path = get_store_path(json_file)
+    if os.path.isfile(join(store_path, "meta.json")):
+        return DvtStore(store_path)
+
+    return IndexedJsonl(json_file)
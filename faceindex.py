@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""Match face embeddings against labelled exemplars of each character.
+
+A FaceIndex holds any number of l2-normalized exemplar embeddings per
+character. Faces are matched either to their nearest exemplars (k-NN,
+with the k most similar exemplars voting by similarity) or to the
+centroid of each character's exemplars. A face whose similarity to the
+chosen character is below a threshold is labelled "unknown".
+
+Matching uses one matrix product against all exemplars by default. For
+casts with thousands of identities an approximate nearest neighbour
+search can be used instead, with the optional hnswlib package.
+
+The index of a series is stored in its model directory as a compressed
+numpy file and is loaded once per process by load_face_index.
+"""
+import os
+import pickle
+
+import numpy as np
+
+from utils import norm_rows, read_user_properties
+
+INDEX_VERSION = 1
+METHODS = ['knn', 'centroid']
+UNKNOWN = "unknown"
+
+# face indexes loaded by this process
+_INDEXES = {}
+
+
+def get_fprint_path(series):
+    """Return the path to the fingerprint file for a series.
+    """
+    base = read_user_properties()['basepath']
+    return os.path.join(base, "model", "fprint", series + "fingerprint.pickle")
+
+
+def stack_fprint(fprint):
+    """Stack a fingerprint dictionary into a normalized matrix.
+
+    Values may be a single embedding or a two-dimensional array holding
+    several exemplars of the same character; each exemplar becomes its
+    own row labelled with the character name.
+
+    Args:
+        fprint: dictionary mapping character names to embeddings.
+    Returns:
+        tuple of a list of names and a matrix with one l2-normalized
+        exemplar per row, in the same order.
+    """
+    names = []
+    rows = []
+    for key, val in fprint.items():
+        val = np.array(val, ndmin=2)
+        names.extend([key] * val.shape[0])
+        rows.append(val)
+
+    if not rows:
+        return names, np.zeros((0, 0))
+
+    return names, norm_rows(np.vstack(rows))
+
+
+class FaceIndex():
+    """Nearest exemplar or centroid lookup of face identities.
+
+    Args:
+        names: list giving the character of each exemplar.
+        embeds: matrix with one exemplar embedding per row.
+        method: either "knn" or "centroid".
+        neighbors: number of exemplars that vote in k-NN matching.
+        threshold: minimum similarity of a match; faces with a lower
+            similarity are unknown. None accepts every match.
+        ann: Boolean value. Should the search use an approximate nearest
+            neighbour index (requires hnswlib).
+    """
+    def __init__(self, names, embeds, method="knn", neighbors=1,
+                 threshold=None, ann=False):
+        if method not in METHODS:
+            raise ValueError('Unknown matching method "' + method + '"')
+
+        self.labels = sorted(set(names))
+        lookup = {name: code for code, name in enumerate(self.labels)}
+        self.codes = np.array([lookup[x] for x in names], dtype=np.int64)
+        self.matrix = norm_rows(embeds).astype(np.float32) if names else \
+            np.zeros((0, 0), dtype=np.float32)
+        self.method = method
+        self.neighbors = max(neighbors, 1)
+        self.threshold = threshold
+
+        self.centroids = np.zeros((len(self.labels), self.matrix.shape[1]),
+                                  dtype=np.float32)
+        np.add.at(self.centroids, self.codes, self.matrix)
+        self.centroids = norm_rows(self.centroids).astype(np.float32) \
+            if self.labels else self.centroids
+
+        self._ann = None
+        if ann and self.labels:
+            self._ann = self._build_ann()
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def from_fprint(cls, fprint, **kwargs):
+        """Create an index from a fingerprint dictionary.
+        """
+        names, matrix = stack_fprint(fprint)
+        return cls(names, matrix, **kwargs)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        """Load an index saved with the 'save' method.
+
+        The matching options are not stored in the file and are given as
+        keyword arguments.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != INDEX_VERSION:
+                raise ValueError("Unsupported face index version in " + path)
+            labels = data['labels'].tolist()
+            names = [labels[x] for x in data['codes']]
+            return cls(names, data['matrix'], **kwargs)
+
+    def save(self, path):
+        """Save the labels and exemplars of the index to a numpy file.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(tmp_path, version=INDEX_VERSION,
+                            labels=np.array(self.labels, dtype=str),
+                            codes=self.codes, matrix=self.matrix)
+        os.replace(tmp_path, path)
+
+    def _build_ann(self):
+        import hnswlib
+
+        points = self.matrix if self.method == "knn" else self.centroids
+        index = hnswlib.Index(space='ip', dim=points.shape[1])
+        index.init_index(max_elements=len(points), ef_construction=200, M=16)
+        index.add_items(points, np.arange(len(points)))
+        index.set_ef(max(50, 2 * self.neighbors))
+
+        return index
+
+    def _search(self, embeds, points, count):
+        # return the rows of the 'count' most similar points and their
+        # similarities, most similar first
+        count = min(count, len(points))
+        if self._ann is not None:
+            rows, dists = self._ann.knn_query(embeds, k=count)
+            return rows.astype(np.int64), 1 - dists
+
+        sims = embeds @ points.T
+        if count < len(points):
+            rows = np.argpartition(-sims, count - 1, axis=1)[:, :count]
+        else:
+            rows = np.tile(np.arange(len(points)), (len(embeds), 1))
+        sims = np.take_along_axis(sims, rows, axis=1)
+        order = np.argsort(-sims, axis=1, kind='stable')
+
+        return np.take_along_axis(rows, order, axis=1), \
+            np.take_along_axis(sims, order, axis=1)
+
+    def query(self, embeds):
+        """Return the most likely character of each face.
+
+        Args:
+            embeds: matrix with one face embedding per row.
+        Returns:
+            tuple of an array of similarity scores and an array of codes
+            indexing into 'labels', where the code len(labels) stands
+            for an unknown face. Without any exemplars every face is
+            unknown with a score of -1.
+        """
+        embeds = np.array(embeds, ndmin=2)
+        if not self.labels or not len(embeds):
+            return np.full(len(embeds), -1.0), \
+                np.full(len(embeds), len(self.labels), dtype=np.int64)
+
+        embeds = norm_rows(embeds).astype(np.float32)
+        if self.method == "centroid":
+            rows, sims = self._search(embeds, self.centroids, 1)
+            codes, scores = rows[:, 0], sims[:, 0]
+        elif self.neighbors == 1:
+            rows, sims = self._search(embeds, self.matrix, 1)
+            codes, scores = self.codes[rows[:, 0]], sims[:, 0]
+        else:
+            codes, scores = self._vote(*self._search(embeds, self.matrix,
+                                                     self.neighbors))
+
+        scores = scores.astype(np.float64)
+        if self.threshold is not None:
+            codes = np.where(scores < self.threshold, len(self.labels),
+                             codes)
+
+        return scores, codes
+
+    def _vote(self, rows, sims):
+        # each neighbour votes for its character with its similarity; the
+        # score is the best similarity among the winning character's votes
+        labels = self.codes[rows]
+        same = labels[:, :, None] == labels[:, None, :]
+        votes = np.sum(same * np.maximum(sims, 0)[:, None, :], axis=2)
+        best = np.max(np.where(same, sims[:, None, :], -np.inf), axis=2)
+
+        # ties, including the case of no positive vote, go to the nearest
+        winner = np.argmax(votes, axis=1)
+        idx = np.arange(len(rows))
+
+        return labels[idx, winner], best[idx, winner]
+
+
+def get_index_path(series):
+    """Return the path to the face index file for a series.
+    """
+    base = read_user_properties()['basepath']
+    return os.path.join(base, "model", "fprint", series + "-faceindex.npz")
+
+
+def get_index_input(series):
+    """Return the file from which the face index of a series is loaded.
+
+    This is the face index file when it exists and the fingerprint
+    pickle file otherwise.
+    """
+    path = get_index_path(series)
+    return path if os.path.isfile(path) else get_fprint_path(series)
+
+
+def load_face_index(series, **kwargs):
+    """Return the FaceIndex of a series, loaded once per process.
+
+    The index is read from the face index file of the series, or built
+    from its fingerprint pickle file when there is no index file.
+    Keyword arguments give the matching options of FaceIndex.
+    """
+    path = get_index_input(series)
+    key = (path, os.stat(path).st_mtime, tuple(sorted(kwargs.items())))
+    if key not in _INDEXES:
+        if path.endswith(".npz"):
+            _INDEXES[key] = FaceIndex.load(path, **kwargs)
+        else:
+            with open(path, "rb") as fin:
+                _INDEXES[key] = FaceIndex.from_fprint(pickle.load(fin),
+                                                      **kwargs)
+
+    return _INDEXES[key]
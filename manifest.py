@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Track which pipeline outputs are up to date.
+
+Each series keeps a json manifest in its staging directory. For every
+stage and episode it records the inputs (size, modification time and a
+content hash), the version of the stage and the parameters used to
+produce the outputs. A stage may then skip an episode whose inputs,
+version and parameters are unchanged and whose outputs still exist.
+"""
+import functools
+import hashlib
+import json
+import os
+from os.path import join
+
+from utils import read_user_properties, update_json
+
+
+def file_hash(path, block_size=2**20):
+    """Return the sha1 hex digest of the contents of a file.
+
+    Args:
+        path: string describing the path to the file.
+        block_size: number of bytes to read at a time.
+    Returns:
+        string giving the hex digest.
+    """
+    sha = hashlib.sha1()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(block_size), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+# sha1 digests of the files hashed or recorded in this process, keyed by
+# path, size and modification time
+_HASHES = {}
+
+
+def _cached_hash(path, stat):
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _HASHES:
+        _HASHES[key] = file_hash(path)
+
+    return _HASHES[key]
+
+
+def file_info(path):
+    """Return the size, modification time and content hash of a file.
+
+    A file is hashed at most once per process for a given size and
+    modification time.
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'sha1': _cached_hash(path, stat)}
+
+
+def _input_matches(path, info):
+    """Check whether a file still matches its recorded information.
+
+    The content hash is only computed when the modification time has
+    changed, so unchanged inputs are checked with a single stat call.
+
+    Returns:
+        the information of the file, with its current modification time,
+        if it matches; None otherwise.
+    """
+    if not os.path.isfile(path):
+        return None
+
+    stat = os.stat(path)
+    if stat.st_size != info['size']:
+        return None
+    if stat.st_mtime == info['mtime']:
+        return info
+    if _cached_hash(path, stat) != info['sha1']:
+        return None
+
+    return dict(info, mtime=stat.st_mtime)
+
+
+def _iter_inputs(data):
+    # (path, info) of the inputs of every stage and episode
+    for entries in data.values():
+        for entry in entries.values():
+            yield from entry['inputs'].items()
+
+
+def _refresh_inputs(infos, data):
+    # store the modification times of files that were touched but whose
+    # contents are unchanged, so that they are not hashed again
+    for path, info in _iter_inputs(data):
+        new = infos.get(path)
+        if new is not None and (info['size'], info['sha1']) == \
+                (new['size'], new['sha1']):
+            info['mtime'] = new['mtime']
+
+
+def _normalize(params):
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+class Manifest():
+    """Read and update the manifest file of a series.
+
+    The file is re-read on every query and updated under an exclusive
+    file lock, so several worker processes may share one manifest.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        if not os.path.isfile(self.path):
+            return {}
+
+        with open(self.path, "r") as fin:
+            return json.load(fin)
+
+    def is_current(self, stage, episode, inputs, outputs, version,
+                   params=None):
+        """Check whether the outputs of a stage are up to date.
+
+        Args:
+            stage: string naming the pipeline stage.
+            episode: string describing the episode.
+            inputs: list of paths to the input files.
+            outputs: list of paths to the output files.
+            version: integer version of the stage.
+            params: json serializable dictionary of parameters.
+        Returns:
+            True if all outputs exist and were produced from the same
+            inputs, version and parameters; False otherwise.
+        """
+        entry = self._read().get(stage, {}).get(episode)
+        if entry is None:
+            return False
+        if entry['version'] != version:
+            return False
+        if entry['params'] != _normalize(params or {}):
+            return False
+        if sorted(entry['outputs']) != sorted(outputs):
+            return False
+        if not all(os.path.isfile(x) for x in outputs):
+            return False
+        if sorted(entry['inputs']) != sorted(inputs):
+            return False
+
+        refreshed = {}
+        for path in inputs:
+            info = _input_matches(path, entry['inputs'][path])
+            if info is None:
+                return False
+            if info is not entry['inputs'][path]:
+                refreshed[path] = info
+        if refreshed:
+            update_json(self.path,
+                        functools.partial(_refresh_inputs, refreshed))
+
+        return True
+
+    def record(self, stage, episode, inputs, outputs, version, params=None):
+        """Record that a stage has produced its outputs for an episode.
+
+        Takes the same arguments as 'is_current'. The recorded hash of an
+        input is reused when its size and modification time are unchanged.
+        """
+        for path, info in _iter_inputs(self._read()):
+            _HASHES.setdefault((path, info['size'], info['mtime']),
+                               info['sha1'])
+
+        entry = {'version': version,
+                 'params': _normalize(params or {}),
+                 'inputs': {x: file_info(x) for x in inputs},
+                 'outputs': list(outputs)}
+
+        update_json(self.path,
+                    lambda data: data.setdefault(stage, {}).update(
+                        {episode: entry}))
+
+
+def get_manifest(series):
+    """Return the Manifest object for a series.
+    """
+    base = read_user_properties()['basepath']
+    return Manifest(join(base, "stage", series, series + "-manifest.json"))
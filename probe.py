@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Probe video files with ffprobe and cache the results.
+
+A single ffprobe call with json output returns the chapters, streams,
+duration and frame rate of a video file. The summaries are cached per
+series in the staging directory, keyed by the size and modification time
+of each file, so unchanged videos are never probed twice.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from os.path import join
+import subprocess
+
+from utils import get_io_paths, timed, update_json
+
+PROBE_VERSION = 1
+
+
+def _rate(value):
+    """Convert a frame rate such as "30000/1001" into a float.
+    """
+    num, _, den = (value or "0/0").partition("/")
+    if not den:
+        return float(num)
+    return float(num) / float(den) if float(den) else 0.0
+
+
+def run_ffprobe(vpath):
+    """Run ffprobe on a video file and return a summary of its contents.
+
+    Args:
+        vpath: string describing the path to the video file.
+    Returns:
+        a dictionary with the duration in seconds, the fps, width and
+        height of the first video stream, a list of chapters (each with
+        a start and end time in seconds and a title), and a list of
+        streams (each with its index, type, codec and language).
+    """
+    with timed("ffprobe"):
+        proc = subprocess.run(['ffprobe', '-v', 'error', '-print_format',
+                               'json', '-show_format', '-show_streams',
+                               '-show_chapters', vpath],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              check=True)
+    raw = json.loads(proc.stdout.decode("utf-8"))
+
+    streams = raw.get('streams', [])
+    video = [x for x in streams if x.get('codec_type') == "video"]
+    video = video[0] if video else {}
+
+    return {
+        'duration': float(raw.get('format', {}).get('duration', 0)),
+        'fps': _rate(video.get('avg_frame_rate')),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'chapters': [{'start': float(x['start_time']),
+                      'end': float(x['end_time']),
+                      'title': x.get('tags', {}).get('title')}
+                     for x in raw.get('chapters', [])],
+        'streams': [{'index': x.get('index'),
+                     'type': x.get('codec_type'),
+                     'codec': x.get('codec_name'),
+                     'language': x.get('tags', {}).get('language')}
+                    for x in streams]
+    }
+
+
+def get_first_pts(vpath):
+    """Return the presentation time of the first video packet of a file.
+
+    Args:
+        vpath: string describing the path to the video file.
+    Returns:
+        the time in seconds, as a float.
+    """
+    proc = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                           '-show_entries', 'packet=pts_time',
+                           '-read_intervals', '%+#1', '-of', 'csv=p=0',
+                           vpath],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          check=True)
+
+    return float(proc.stdout.decode("utf-8").split()[0].strip(","))
+
+
+def get_probe_cache_path(episode):
+    """Return the path of the probe cache for the series of an episode.
+    """
+    series = episode.split("-")[0]
+    return join(get_io_paths(episode)['spath'], series + "-probe.json")
+
+
+def probe_file(vpath, cache_path=None):
+    """Return the probe summary of a video file, using a cache if given.
+
+    The cached summary is used when the video has the same size and
+    modification time as when it was probed.
+
+    Args:
+        vpath: string describing the path to the video file.
+        cache_path: optional path of the json cache file.
+    Returns:
+        a dictionary as returned by run_ffprobe.
+    """
+    if cache_path is None:
+        return run_ffprobe(vpath)
+
+    vpath = os.path.abspath(vpath)
+    stat = os.stat(vpath)
+    key = {'size': stat.st_size, 'mtime': stat.st_mtime,
+           'version': PROBE_VERSION}
+
+    if os.path.isfile(cache_path):
+        with open(cache_path, "r") as fin:
+            entry = json.load(fin).get(vpath)
+        if entry is not None and entry['key'] == key:
+            return entry['info']
+
+    info = run_ffprobe(vpath)
+    update_json(cache_path, lambda data: data.update(
+        {vpath: {'key': key, 'info': info}}))
+
+    return info
+
+
+def probe(episode):
+    """Return the cached probe summary of the video of an episode.
+    """
+    return probe_file(get_io_paths(episode)['ifile'],
+                      get_probe_cache_path(episode))
+
+
+def probe_many(episodes, jobs=4):
+    """Probe the videos of several episodes concurrently.
+
+    Args:
+        episodes: list of episode identifiers.
+        jobs: maximum number of ffprobe processes to run at once.
+    Returns:
+        a dictionary mapping each episode to its probe summary, or to
+        None if the video is missing or cannot be probed.
+    """
+    def safe_probe(episode):
+        try:
+            return probe(episode)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return dict(zip(episodes, executor.map(safe_probe, episodes)))
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""Schedule the pipeline stages of a series over several machines.
+
+This callable module keeps a queue of (episode, stage) jobs in the
+staging directory of a series. Any number of workers, on one or several
+machines sharing the base path, claim jobs from the queue and run them
+with the functions of the stage scripts:
+
+    audio   script02_extract_audio_text.py
+    dvt     script03_run_dvt.py
+    json    script05_process_json.py
+
+A job is only claimed once the earlier stages of its episode that are in
+the queue have finished. Failed jobs are retried after an exponentially
+growing delay, up to a maximum number of attempts. Running workers
+update a heartbeat on their job; a job whose heartbeat is older than the
+lease (for example because its machine went down) is handed to another
+worker.
+
+The queue is a json file that is only changed under an exclusive file
+lock, so the shared filesystem must support fcntl locks (as do local
+filesystems and NFSv4).
+
+Example:
+    To queue every stage of season 2 of Bewitched, sampling faces on
+    every fourth frame, and then run four workers on this machine, we
+    would run the following:
+
+        $ python3 scheduler.py --series bw --season 2 --submit \
+                               --dvt-options="--persistent --face-stride 4"
+        $ python3 scheduler.py --series bw --work --jobs 4 --verbose
+
+    Workers on a machine with a GPU may be restricted to the dvt stage
+    with "--stages dvt". To show the state of the queue and the
+    throughput of each stage and worker, run:
+
+        $ python3 scheduler.py --series bw --status
+
+"""
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import functools
+import importlib
+import json
+import os
+from os.path import join
+import shlex
+import socket
+import threading
+import time
+import traceback
+
+from utils import default_option_parser, get_episodes, get_series_paths, \
+                  iso8601, run_episodes, update_json
+
+STAGES = ['audio', 'dvt', 'json']
+STAGE_FUNCTIONS = {
+    'audio': ("script02_extract_audio_text", "convert_episode"),
+    'dvt': ("script03_run_dvt", "run_episode"),
+    'json': ("script05_process_json", "process_episode")
+}
+DEFAULT_OPTIONS = {'audio': "--audio --text", 'dvt': "--persistent",
+                   'json': ""}
+STATES = ['pending', 'running', 'done', 'failed']
+
+# stage functions set up by this process, keyed by stage and options
+_STAGE_FUNCS = {}
+
+
+def get_queue_path(series):
+    """Return the path of the job queue of a series.
+    """
+    return join(get_series_paths(series)['spath'], series + "-queue.json")
+
+
+def get_job_key(episode, stage):
+    """Return the identifier of the job running a stage on an episode.
+    """
+    return episode + ":" + stage
+
+
+def _is_blocked(jobs, job, states):
+    # an earlier queued stage of the episode is not in one of 'states'
+    for stage in STAGES[:STAGES.index(job['stage'])]:
+        other = jobs.get(get_job_key(job['episode'], stage))
+        if other is not None and other['state'] not in states:
+            return True
+
+    return False
+
+
+class JobQueue():
+    """Claim and update the jobs of a queue file.
+
+    Every change reads the file, applies the change and replaces the file
+    while holding an exclusive lock, so the queue may be shared by worker
+    processes on several machines.
+
+    Args:
+        path: string describing the path to the queue file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        if not os.path.isfile(self.path):
+            return {}
+
+        with open(self.path, "r") as fin:
+            return json.load(fin)
+
+    def _update(self, update):
+        # apply update to the jobs dictionary and return its result
+        result = []
+        update_json(self.path, lambda data: result.append(
+            update(data.setdefault('jobs', {}))))
+
+        return result[0]
+
+    def jobs(self):
+        """Return a dictionary of all jobs, keyed by job identifier.
+        """
+        return self._read().get('jobs', {})
+
+    def submit(self, episodes, stages, options, max_attempts=3, backoff=60,
+               requeue=False):
+        """Add the jobs running each stage on each episode.
+
+        Args:
+            episodes: list of episode identifiers.
+            stages: list of stage names, from STAGES.
+            options: dictionary giving the command line options passed to
+                the script of each stage.
+            max_attempts: number of times a failing job is run.
+            backoff: delay in seconds before the first retry; the delay
+                doubles with every further attempt.
+            requeue: Boolean value. Should jobs already in the queue be
+                reset, whatever their state.
+        Returns:
+            the number of jobs added or reset.
+        """
+        def add(jobs):
+            count = 0
+            for episode in episodes:
+                for stage in stages:
+                    key = get_job_key(episode, stage)
+                    if key in jobs and not requeue:
+                        continue
+                    jobs[key] = {'episode': episode, 'stage': stage,
+                                 'options': options[stage],
+                                 'state': "pending", 'attempts': 0,
+                                 'max_attempts': max_attempts,
+                                 'backoff': backoff, 'not_before': 0,
+                                 'submitted': time.time()}
+                    count += 1
+            return count
+
+        return self._update(add)
+
+    def retry_failed(self):
+        """Reset the failed jobs so that they are run again.
+
+        Returns:
+            the number of jobs reset.
+        """
+        def reset(jobs):
+            failed = [x for x in jobs.values() if x['state'] == "failed"]
+            for job in failed:
+                job.update(state="pending", attempts=0, not_before=0)
+            return len(failed)
+
+        return self._update(reset)
+
+    def claim(self, worker, stages=STAGES, lease=600):
+        """Claim the next job that is ready to run.
+
+        Jobs of later stages are claimed first, so that episodes move
+        through the pipeline rather than piling up after the first stage.
+        A running job whose heartbeat is older than its lease is first
+        returned to the queue, or failed if it has no attempts left.
+
+        Args:
+            worker: string identifying the worker.
+            stages: list of the stages this worker runs.
+            lease: seconds after the last heartbeat before the job may be
+                given to another worker.
+        Returns:
+            tuple of the claimed job (None if no job is ready) and the
+            number of unfinished jobs that may still become ready.
+        """
+        def take(jobs):
+            now = time.time()
+            for job in jobs.values():
+                if job['state'] == "running" and \
+                        now - job['heartbeat'] > job['lease']:
+                    job['error'] = "lease of worker {0:s} expired".format(
+                        job['worker'])
+                    job['state'] = "pending" if \
+                        job['attempts'] < job['max_attempts'] else "failed"
+
+            open_jobs = [x for x in jobs.values()
+                         if x['state'] in ["pending", "running"] and
+                         x['stage'] in stages and
+                         not _is_blocked(jobs, x, ["pending", "running",
+                                                   "done"])]
+            ready = [x for x in open_jobs if x['state'] == "pending" and
+                     x['not_before'] <= now and
+                     not _is_blocked(jobs, x, ["done"])]
+            if not ready:
+                return None, len(open_jobs)
+
+            job = min(ready, key=lambda x: (-STAGES.index(x['stage']),
+                                            x['episode']))
+            job.update(state="running", worker=worker, lease=lease,
+                       started=now, heartbeat=now,
+                       attempts=job['attempts'] + 1)
+            return dict(job), len(open_jobs)
+
+        return self._update(take)
+
+    def heartbeat(self, key, worker):
+        """Record that a worker is still running a job.
+        """
+        def beat(jobs):
+            job = jobs[key]
+            if job['state'] == "running" and job['worker'] == worker:
+                job['heartbeat'] = time.time()
+
+        self._update(beat)
+
+    def finish(self, key, worker, error=None):
+        """Record the result of a job.
+
+        A failed job is returned to the queue with a delay of 'backoff'
+        times two to the power of the number of earlier attempts, until
+        it has used all of its attempts.
+
+        Args:
+            key: identifier of the job.
+            worker: string identifying the worker that ran the job.
+            error: the error message if the job failed, otherwise None.
+        Returns:
+            None
+        """
+        def end(jobs):
+            job = jobs[key]
+            if job['state'] != "running" or job['worker'] != worker:
+                return      # the lease expired and the job was reassigned
+
+            now = time.time()
+            job.update(finished=now, seconds=now - job['started'])
+            if error is None:
+                job.update(state="done", error=None)
+            elif job['attempts'] < job['max_attempts']:
+                job.update(state="pending", error=error,
+                           not_before=now + job['backoff'] *
+                           2 ** (job['attempts'] - 1))
+            else:
+                job.update(state="failed", error=error)
+
+        self._update(end)
+
+
+@contextlib.contextmanager
+def _heartbeat(queue, key, worker, interval):
+    # update the heartbeat of a job from a background thread
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            queue.heartbeat(key, worker)
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def get_stage_function(series, stage, options):
+    """Return a function running a stage on an episode.
+
+    The options are parsed by the script of the stage, and the function
+    is kept for the lifetime of the process so that stages such as dvt
+    with --persistent keep their models loaded between jobs.
+
+    Args:
+        series: string describing the series.
+        stage: name of the stage, from STAGES.
+        options: command line options of the stage script, as a string.
+    Returns:
+        a function taking an episode identifier.
+    """
+    key = (series, stage, options)
+    if key not in _STAGE_FUNCS:
+        module_name, func_name = STAGE_FUNCTIONS[stage]
+        module = importlib.import_module(module_name)
+        args = module.get_args(["--series", series] + shlex.split(options))
+        _STAGE_FUNCS[key] = functools.partial(getattr(module, func_name),
+                                              args=args)
+
+    return _STAGE_FUNCS[key]
+
+
+def run_job(key, queue, worker, jobs, interval):
+    """Run the last claimed job and record its result in the queue.
+    """
+    job = jobs[-1]
+    try:
+        with _heartbeat(queue, key, worker, interval):
+            func = get_stage_function(job['episode'].split("-")[0],
+                                      job['stage'], job['options'])
+            func(job['episode'])
+    except Exception:
+        queue.finish(key, worker, traceback.format_exc())
+        raise
+
+    queue.finish(key, worker)
+
+
+def claim_jobs(queue, worker, jobs, args):
+    """Yield the identifiers of the jobs claimed by a worker.
+
+    Each claimed job is also appended to the list 'jobs'. When no job is
+    ready the worker waits, and it stops once no unfinished job is left
+    that it could run.
+    """
+    while True:
+        job, remaining = queue.claim(worker, args.stages, args.lease)
+        if job is not None:
+            jobs.append(job)
+            yield get_job_key(job['episode'], job['stage'])
+        elif remaining:
+            time.sleep(args.poll)
+        else:
+            return
+
+
+def work(args):
+    """Run a worker that processes jobs until the queue is finished.
+
+    Returns:
+        the number of jobs run by the worker.
+    """
+    queue = JobQueue(get_queue_path(args.series))
+    worker = "{0:s}:{1:d}".format(socket.gethostname(), os.getpid())
+
+    jobs = []
+    start = time.time()
+    run_episodes(functools.partial(run_job, queue=queue, worker=worker,
+                                   jobs=jobs, interval=args.lease / 4),
+                 claim_jobs(queue, worker, jobs, args), verbose=args.verbose,
+                 metrics=args.metrics, profile=args.profile)
+
+    seconds = max(time.time() - start, 1e-6)
+    print("[{0:s}] Worker {1:s} ran {2:d} jobs in {3:.1f} seconds "
+          "({4:.1f} jobs per hour)".format(iso8601(), worker, len(jobs),
+                                           seconds,
+                                           3600 * len(jobs) / seconds))
+
+    return len(jobs)
+
+
+def _rate(jobs):
+    # jobs finished per hour, over the time from the first start to the
+    # last finish
+    done = [x for x in jobs if x['state'] == "done"]
+    if not done:
+        return 0.0
+    seconds = max(x['finished'] for x in done) - \
+        min(x['started'] for x in done)
+
+    return 3600 * len(done) / seconds if seconds > 0 else 0.0
+
+
+def print_status(queue):
+    """Print the number of jobs in each state and the throughput.
+    """
+    jobs = queue.jobs()
+    now = time.time()
+
+    print("{0:<8s} {1:>8s} {2:>8s} {3:>8s} {4:>8s} {5:>10s} {6:>10s}".format(
+        "stage", *STATES, "jobs/hour", "mean sec"))
+    for stage in STAGES:
+        subset = [x for x in jobs.values() if x['stage'] == stage]
+        if not subset:
+            continue
+        counts = [sum(x['state'] == y for x in subset) for y in STATES]
+        seconds = [x['seconds'] for x in subset if x['state'] == "done"]
+        print("{0:<8s} {1:>8d} {2:>8d} {3:>8d} {4:>8d} {5:>10.1f} "
+              "{6:>10.1f}".format(stage, *counts, _rate(subset),
+                                  sum(seconds) / max(len(seconds), 1)))
+
+    workers = sorted(set(x['worker'] for x in jobs.values()
+                         if 'worker' in x))
+    if workers:
+        print("\n{0:<32s} {1:>8s} {2:>10s}  {3:s}".format(
+            "worker", "done", "jobs/hour", "running"))
+    for worker in workers:
+        subset = [x for x in jobs.values() if x.get('worker') == worker]
+        running = ["{0:s} ({1:.0f}s ago)".format(
+            get_job_key(x['episode'], x['stage']), now - x['heartbeat'])
+            for x in subset if x['state'] == "running"]
+        print("{0:<32s} {1:>8d} {2:>10.1f}  {3:s}".format(
+            worker, sum(x['state'] == "done" for x in subset),
+            _rate(subset), ", ".join(running)))
+
+    failed = sorted(key for key, x in jobs.items() if x['state'] == "failed")
+    for key in failed:
+        error = jobs[key]['error'].strip().splitlines()
+        print("\nFAILED {0:s} after {1:d} attempts: {2:s}".format(
+            key, jobs[key]['attempts'], error[-1] if error else ""))
+
+
+def get_args():
+    """Return the arguments of this script.
+    """
+    desc = 'Queue and run the pipeline stages of a series.'
+    parser = default_option_parser(desc)
+    parser.add_argument('--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--submit', dest='submit', action='store_true',
+                        help='queue the selected stages of the selected '
+                             'episodes; with --force, jobs already in the '
+                             'queue are reset')
+    parser.add_argument('--work', dest='work', action='store_true',
+                        help='run --jobs workers on this machine until the '
+                             'queue is finished')
+    parser.add_argument('--status', dest='status', action='store_true',
+                        help='print the state and throughput of the queue')
+    parser.add_argument('--retry-failed', dest='retry_failed',
+                        action='store_true',
+                        help='reset the jobs that used all of their attempts')
+    parser.add_argument('--stages', dest='stages', nargs='+',
+                        default=STAGES, choices=STAGES,
+                        help='stages to queue, or stages a worker runs')
+    for stage in STAGES:
+        parser.add_argument('--' + stage + '-options',
+                            dest=stage + '_options',
+                            default=DEFAULT_OPTIONS[stage],
+                            help='options of the ' + stage + ' stage script, '
+                                 'as one string; defaults to "' +
+                                 DEFAULT_OPTIONS[stage] + '"')
+    parser.add_argument('--max-attempts', dest='max_attempts', type=int,
+                        default=3,
+                        help='number of times a failing job is run')
+    parser.add_argument('--backoff', dest='backoff', type=float, default=60,
+                        help='seconds before the first retry of a failed '
+                             'job; doubled on every further attempt')
+    parser.add_argument('--lease', dest='lease', type=float, default=600,
+                        help='seconds without a heartbeat after which a '
+                             'running job is given to another worker')
+    parser.add_argument('--poll', dest='poll', type=float, default=30,
+                        help='seconds a worker waits when no job is ready')
+
+    args = parser.parse_args()
+    if not (args.submit or args.work or args.status or args.retry_failed):
+        parser.error("select at least one of --submit, --retry-failed, "
+                     "--work and --status")
+
+    return args
+
+
+def run_scheduler():
+    """Run the module with the selected user arguments.
+    """
+    args = get_args()
+    queue = JobQueue(get_queue_path(args.series))
+
+    if args.submit:
+        options = {x: getattr(args, x + '_options') for x in STAGES}
+        count = queue.submit(get_episodes(args), args.stages, options,
+                             args.max_attempts, args.backoff, args.force)
+        print("Queued {0:d} jobs".format(count))
+    if args.retry_failed:
+        print("Reset {0:d} failed jobs".format(queue.retry_failed()))
+
+    if args.work and args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            list(executor.map(work, [args] * args.jobs))
+    elif args.work:
+        work(args)
+
+    if args.status:
+        print_status(queue)
+
+
+if __name__ == "__main__":
+    run_scheduler()
@@ -4,7 +4,9 @@
 This callable module is used to extract mp3 and srt files from the raw
 input video files. You can select the series and (optionally) the season
 and episodes using command line arguments. You must also turn on the flags
-for text and/or audio extraction (neither are run by default).
+for text and/or audio extraction (neither are run by default). When both
+are selected they are extracted in a single ffmpeg pass, and the --jobs
+option sets how many episodes are converted at the same time.
 
 Example:
     To process the first 5 episodes from season 2 of Bewitched,
@@ -17,10 +19,16 @@ Example:
 
 Note: you must run this file in the docker image.
 """
+import functools
 import os
 import subprocess
+import sys
 
-from utils import default_option_parser, get_episodes, get_io_paths
+from manifest import get_manifest
+from utils import default_option_parser, file_size, get_episodes, \
+                  get_io_paths, run_episodes, timed
+
+STAGE_VERSION = 1
 
 
 def get_audio(episode, verbose=True):
@@ -39,8 +47,10 @@ def get_audio(episode, verbose=True):
     with open(os.devnull, 'w') as devnull:
         if os.path.isfile(ofile):
             os.remove(ofile)
-        subprocess.run(["ffmpeg", "-i", ifile, "-ab", "192k", ofile],
-                       stdout=devnull, stderr=devnull)
+        with timed("ffmpeg", bytes_read=file_size(ifile)) as counts:
+            subprocess.run(["ffmpeg", "-i", ifile, "-ab", "192k", ofile],
+                           stdout=devnull, stderr=devnull)
+            counts['bytes_written'] = file_size(ofile)
         if verbose:
             print("Converted {0:s} to {1:s}".format(os.path.basename(ifile),
                                                     os.path.basename(ofile)))
@@ -62,23 +72,107 @@ def get_text(episode, verbose):
     with open(os.devnull, 'w') as devnull:
         if os.path.isfile(ofile):
             os.remove(ofile)
-        subprocess.run(["ffmpeg", "-i", ifile, "-ab", "192k", ofile],
-                       stdout=devnull, stderr=devnull)
+        with timed("ffmpeg", bytes_read=file_size(ifile)) as counts:
+            subprocess.run(["ffmpeg", "-i", ifile, "-ab", "192k", ofile],
+                           stdout=devnull, stderr=devnull)
+            counts['bytes_written'] = file_size(ofile)
         if verbose:
             print("Converted {0:s} to {1:s}".format(os.path.basename(ifile),
                                                     os.path.basename(ofile)))
 
 
-def get_args():
-    """Return the argument parser for this script.
+def get_audio_text(episode, verbose):
+    """For a given episode, extract the mp3 and srt files in one pass.
+
+    A single ffmpeg process demuxes the video once and writes both
+    outputs. If this fails, for example because the video has no subtitle
+    stream, the files are extracted one at a time instead.
+
+    Args:
+        episode: String describing the episode to parse
+        verbose: Boolean value. Should progress be printed to the console.
+    Returns:
+        None
+    """
+    paths = get_io_paths(episode)
+    ifile = paths['ifile']
+    ofiles = [paths['ifile_mp3'], paths['ifile_srt']]
+
+    with open(os.devnull, 'w') as devnull:
+        for ofile in ofiles:
+            if os.path.isfile(ofile):
+                os.remove(ofile)
+        with timed("ffmpeg", bytes_read=file_size(ifile)) as counts:
+            proc = subprocess.run(["ffmpeg", "-i", ifile,
+                                   "-map", "0:a:0", "-ab", "192k", ofiles[0],
+                                   "-map", "0:s:0", ofiles[1]],
+                                  stdout=devnull, stderr=devnull)
+            counts['bytes_written'] = sum(file_size(x) for x in ofiles)
+
+    if proc.returncode != 0:
+        get_audio(episode, verbose)
+        get_text(episode, verbose)
+        return
+
+    if verbose:
+        print("Converted {0:s} to {1:s} and {2:s}".format(
+            os.path.basename(ifile), os.path.basename(ofiles[0]),
+            os.path.basename(ofiles[1])))
+
+
+def get_args(argv=None):
+    """Return the arguments of this script.
+
+    Args:
+        argv: list of command line arguments; defaults to sys.argv.
     """
     desc = 'Extract mp3 and srt files.'
     parser = default_option_parser(desc)
     parser.add_argument('--audio', dest='audio', action='store_true')
     parser.add_argument('--text', dest='text', action='store_true')
     parser.add_argument('--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--separate', dest='separate', action='store_true',
+                        help='run a separate ffmpeg pass for the audio and '
+                             'text files')
+
+    return parser.parse_args(argv)
+
+
+def convert_episode(episode, args):
+    """Extract the selected audio and text files for one episode.
+
+    Files whose input video has not changed since they were last
+    extracted are skipped, unless the --force flag is given. When both
+    files are needed they are extracted with a single ffmpeg pass.
+    """
+    paths = get_io_paths(episode)
+    manifest = get_manifest(episode.split("-")[0])
 
-    return parser.parse_args()
+    stages = []
+    for stage, flag, func, ofile in [
+            ("audio", args.audio, get_audio, paths['ifile_mp3']),
+            ("text", args.text, get_text, paths['ifile_srt'])]:
+        if not flag:
+            continue
+
+        if not args.force and manifest.is_current(
+                stage, episode, [paths['ifile']], [ofile], STAGE_VERSION):
+            if args.verbose:
+                print("Skipping {0:s}; up to date".format(
+                    os.path.basename(ofile)))
+            continue
+
+        stages.append((stage, func, ofile))
+
+    if len(stages) == 2 and not args.separate:
+        get_audio_text(episode, args.verbose)
+    else:
+        for _, func, _ in stages:
+            func(episode, args.verbose)
+
+    for stage, _, ofile in stages:
+        manifest.record(stage, episode, [paths['ifile']], [ofile],
+                        STAGE_VERSION)
 
 
 def run_text_audio_convert():
@@ -86,13 +180,14 @@ def run_text_audio_convert():
     """
     args = get_args()
 
-    for episode in get_episodes(args):
-
-        if args.audio:
-            get_audio(episode, args.verbose)
-
-        if args.text:
-            get_text(episode, args.verbose)
+    # the work happens in ffmpeg subprocesses, so threads are enough to run
+    # several episodes at once
+    failed = run_episodes(functools.partial(convert_episode, args=args),
+                          get_episodes(args), jobs=args.jobs,
+                          verbose=args.verbose, threads=True,
+                          metrics=args.metrics, profile=args.profile)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -12,11 +12,63 @@ Example:
 
         $ python3 script03_run_dvt.py --series bw --season 2 --episode 1 2 3 4
 
+    To keep the models loaded while reading episode identifiers from a
+    queue on standard input, one per line, run a worker instead:
+
+        $ ls /media/data/dv/input/bw | sed 's/.mp4//' | \
+              python3 script03_run_dvt.py --series bw --worker
+
+    To run the face detector on every tenth frame and on the first frame
+    of each shot only, run the following:
+
+        $ python3 script03_run_dvt.py --series bw --season 2 \
+                                      --face-stride 10 --face-cuts
+
+    To first find the shots and then detect faces on three frames of
+    each shot only, run the following:
+
+        $ python3 script03_run_dvt.py --series bw --season 2 --two-pass \
+                                      --shot-samples 3
+
+    To continue episodes whose annotation was interrupted from the last
+    frame that was written, rather than from the start, add --resume:
+
+        $ python3 script03_run_dvt.py --series bw --season 2 --resume
+
+    To split each episode into five minute chunks and annotate four
+    chunks at a time, run the following:
+
+        $ python3 script03_run_dvt.py --series bw --season 2 \
+                                      --chunk-seconds 300 --chunk-jobs 4
+
 """
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import functools
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 from os.path import join
 
-from utils import default_option_parser, get_episodes, get_io_paths
+import numpy as np
+
+from dvtstore import get_sampling_path, get_store_path, write_store
+from manifest import get_manifest
+from probe import get_first_pts, probe_file
+from script05_process_json import DVAL_CUT, load_shot_signals, \
+                                  segment_shots
+from utils import build_jsonl_index, default_option_parser, file_size, \
+                  get_episodes, get_io_paths, iter_jsonl, run_episodes, \
+                  timed, truncate_jsonl, update_json
+
+STAGE_VERSION = 1
+
+# annotator pipeline kept alive across episodes in persistent mode
+_PROCESSOR = {}
 
 
 def setup_tensorflow():
@@ -30,24 +82,158 @@ def setup_tensorflow():
     set_session(tf.Session(config=config))
 
 
+class SampledAnnotator():
+    """Run a dvt frame annotator on a subset of the frames.
+
+    The wrapped annotator sees the first frame of the video and every
+    'stride'-th frame after it, or no others when 'stride' is zero. When
+    'dval_cut' is given it also sees every frame whose median diff
+    exceeds the cut, which are the candidate first frames of shots; this
+    requires the diff annotator to come earlier in the pipeline. When
+    'frames' is given it sees exactly the frames in that set instead. All
+    other attributes are those of the wrapped annotator.
+    """
+    def __init__(self, annotator, stride=1, dval_cut=None, frames=None):
+        self.annotator = annotator
+        self.stride = stride
+        self.dval_cut = dval_cut
+        self.frames = frames
+        self.count = 0
+        self.calls = 0
+        self.seconds = 0.0
+
+    def __getattr__(self, key):
+        return getattr(self.annotator, key)
+
+    def reset(self):
+        """Start counting frames again, from the start of a new video.
+
+        Also resets the number of calls to the wrapped annotator and the
+        time spent in them.
+        """
+        self.count = 0
+        self.calls = 0
+        self.seconds = 0.0
+
+    def process_next(self, img, foutput):
+        """Pass the frame to the wrapped annotator if it is sampled.
+        """
+        if self.frames is not None:
+            sampled = self.count in self.frames
+        else:
+            sampled = self.count == 0 or (self.stride > 0 and
+                                          self.count % self.stride == 0)
+        if not sampled and self.dval_cut is not None and 'diff' in foutput:
+            sampled = foutput['diff']['decile'][5] > self.dval_cut
+        self.count += 1
+
+        if not sampled:
+            return foutput
+
+        start = time.perf_counter()
+        foutput = self.annotator.process_next(img, foutput)
+        self.calls += 1
+        self.seconds += time.perf_counter() - start
+
+        return foutput
+
+
+def get_sampling(args):
+    """Return a description of the frames sampled for each annotator.
+
+    This is None when every annotator sees every frame.
+    """
+    if args.face_stride == 1:
+        return None
+
+    return {'face': {'stride': args.face_stride,
+                     'dval_cut': DVAL_CUT if args.face_cuts else None}}
+
+
+def set_sampling(json_file, sampling):
+    """Record the frame sampling of a dvt json file in its sampling file.
+
+    The sampling file is removed when 'sampling' is None, so that it never
+    describes an earlier run.
+    """
+    sampling_path = get_sampling_path(json_file)
+    if sampling is None:
+        if os.path.isfile(sampling_path):
+            os.remove(sampling_path)
+        return
+
+    tmp_path = sampling_path + ".tmp"
+    with open(tmp_path, "w") as fout:
+        json.dump(sampling, fout)
+    os.replace(tmp_path, sampling_path)
+
+
 def get_processor(args):
     """Construct and return the dvt VideoProcessor object.
     """
     import dvt
 
+    sampling = get_sampling(args) or {}
+    face = dvt.frame.FaceFrameAnnotator()
+    if 'face' in sampling:
+        face = SampledAnnotator(face, **sampling['face'])
+
     vproc = dvt.video.VideoProcessor()
     vproc.load_annotator(dvt.frame.DiffFrameAnnotator())
     vproc.load_annotator(dvt.frame.HistogramFrameAnnotator())
     vproc.load_annotator(dvt.frame.TerminateFrameAnnotator())
     # vproc.load_annotator(dvt.frame.ObjectCocoFrameAnnotator())
-    vproc.load_annotator(dvt.frame.FaceFrameAnnotator())
+    vproc.load_annotator(face)
     if args.png_flag:
         vproc.load_annotator(dvt.frame.PngFrameAnnotator(output_dir="/"))
     return vproc
 
 
-def process_video(vproc, video_file, json_file, frame_path, args):
+def get_shot_processor(args):
+    """Construct the VideoProcessor of the first pass of --two-pass.
+
+    Only the cheap diff and histogram annotators are run.
+    """
+    import dvt
+
+    vproc = dvt.video.VideoProcessor()
+    vproc.load_annotator(dvt.frame.DiffFrameAnnotator())
+    vproc.load_annotator(dvt.frame.HistogramFrameAnnotator())
+    vproc.load_annotator(dvt.frame.TerminateFrameAnnotator())
+    if args.png_flag:
+        vproc.load_annotator(dvt.frame.PngFrameAnnotator(output_dir="/"))
+    return vproc
+
+
+def get_face_processor(args):
+    """Construct the VideoProcessor of the second pass of --two-pass.
+
+    The face annotator only sees the frames in the 'frames' attribute of
+    its SampledAnnotator, which is set before each video.
+    """
+    import dvt
+
+    vproc = dvt.video.VideoProcessor()
+    vproc.load_annotator(SampledAnnotator(dvt.frame.FaceFrameAnnotator(),
+                                          frames=set()))
+    return vproc
+
+
+def get_persistent_processor(args, factory=get_processor):
+    """Return a VideoProcessor that is only constructed once per process.
+    """
+    if factory.__name__ not in _PROCESSOR:
+        _PROCESSOR[factory.__name__] = factory(args)
+
+    return _PROCESSOR[factory.__name__]
+
+
+def process_video(vproc, video_file, json_file, frame_path, args,
+                  stage="dvt", start_frame=0):
     """Run a VideoProcessor object over the data.
+
+    When the video is the remainder of a longer video starting at
+    'start_frame', frame sampling continues from that frame.
     """
 
     # make sure staging area has been created
@@ -59,22 +245,575 @@ def process_video(vproc, video_file, json_file, frame_path, args):
         vproc.pipeline['png'].output_dir = frame_path
 
     # clear the pipeline and setup metadata
-    vproc.pipeline['diff'].clear()
+    if 'diff' in vproc.pipeline:
+        vproc.pipeline['diff'].clear()
+    for anno in vproc.pipeline.values():
+        if isinstance(anno, SampledAnnotator):
+            anno.reset()
+            anno.count = start_frame
     vproc.setup_input(video_path=video_file, output_path=json_file)
 
     # run the pipeline
-    vproc.process(verbose=args.verbose)
+    with timed(stage, bytes_read=file_size(video_file)) as counts:
+        vproc.process(verbose=args.verbose)
+        counts['bytes_written'] = file_size(json_file)
+
+
+def get_shot_samples(json_file, samples):
+    """Choose the frames of each shot on which to detect faces.
+
+    The shots are found as in script05, with its default thresholds, and
+    up to 'samples' frames are taken evenly spaced within each shot. Each
+    frame of a shot is assigned to the nearest of its sampled frames.
+
+    Args:
+        json_file: path to a dvt json file with diff and histograms.
+        samples: number of frames to take from each shot.
+    Returns:
+        dictionary mapping each frame number to the number of the sampled
+        frame whose faces it takes.
+    """
+    _, frames, hist, dval = load_shot_signals(json_file)
+    _, sid, _ = segment_shots(frames, hist, dval)
+
+    frames = np.asarray(frames)
+    starts = np.flatnonzero(np.diff(sid, prepend=-1))
+    sizes = np.diff(np.append(starts, len(sid)))
+    sources = {}
+    for start, size in zip(starts, sizes):
+        count = min(samples, size)
+        rows = start + ((np.arange(count) + 0.5) * size / count).astype(int)
+        shot = np.arange(start, start + size)
+        nearest = np.argmin(np.abs(shot[:, None] - rows[None, :]), axis=1)
+        sources.update(zip(frames[shot].tolist(),
+                           frames[rows[nearest]].tolist()))
+
+    return sources
+
+
+def merge_faces(shot_file, face_file, json_file, sources):
+    """Add the faces found in the second pass to the first pass output.
+
+    Every frame takes the faces of its sampled frame in 'sources', as from
+    get_shot_samples, so the faces of a shot are propagated to all of its
+    frames.
+    """
+    faces = {}
+    for line in iter_jsonl(face_file):
+        if line['type'] == "frame" and line.get('face'):
+            faces[line['frame']] = line['face']
+
+    tmp_file = json_file + ".tmp"
+    with open(tmp_file, "w") as fout:
+        for line in iter_jsonl(shot_file):
+            if line['type'] == "frame" and \
+                    sources.get(line['frame']) in faces:
+                line['face'] = faces[sources[line['frame']]]
+            fout.write(json.dumps(line) + "\n")
+    os.replace(tmp_file, json_file)
+
+
+def process_video_two_pass(video_file, json_file, frame_path, args):
+    """Run the dvt pipeline in two passes over a video.
+
+    The first pass computes the diff and histogram annotations and finds
+    the shots; the second pass decodes the video again but only runs the
+    face detector on --shot-samples frames of each shot, and the faces
+    are then propagated to the other frames of the shot. The time of each
+    pass is reported as the "dvt_shots" and "dvt_faces" stages. With
+    --verbose the speedup over a single pass is printed, estimated from
+    the measured time per face detection.
+    """
+    if args.persistent or args.worker:
+        shot_proc = get_persistent_processor(args, get_shot_processor)
+        face_proc = get_persistent_processor(args, get_face_processor)
+    else:
+        shot_proc = get_shot_processor(args)
+        face_proc = get_face_processor(args)
+
+    shot_file = json_file[:-6] + "-shots.jsonl"
+    face_file = json_file[:-6] + "-faces.jsonl"
+    start = time.perf_counter()
+    try:
+        process_video(shot_proc, video_file, shot_file, frame_path, args,
+                      stage="dvt_shots")
+        shot_seconds = time.perf_counter() - start
+        with timed("sample") as counts:
+            sources = get_shot_samples(shot_file, args.shot_samples)
+            chosen = set(sources.values())
+            counts['items'] = len(chosen)
+
+        # frames are exported by the first pass, which sees every frame
+        face_args = copy.copy(args)
+        face_args.png_flag = False
+        face_proc.pipeline['face'].frames = chosen
+        process_video(face_proc, video_file, face_file, None, face_args,
+                      stage="dvt_faces")
+        with timed("merge", items=len(sources)):
+            merge_faces(shot_file, face_file, json_file, sources)
+    finally:
+        for path in [shot_file, face_file]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    if args.verbose:
+        # a single pass runs the detector on every frame, and decodes the
+        # video and runs the other annotators as the first pass does
+        seconds = time.perf_counter() - start
+        detector = face_proc.pipeline['face']
+        single = shot_seconds + \
+            detector.seconds / max(detector.calls, 1) * len(sources)
+        print("Detected faces on {0:d} of {1:d} frames in {2:.1f} seconds; "
+              "about {3:.1f} times faster than a single pass ({4:.1f} "
+              "seconds)".format(len(chosen), len(sources), seconds,
+                                single / max(seconds, 1e-9), single))
+
+
+def split_video(video_file, chunk_path, seconds):
+    """Split the video stream of a file into chunks of about equal length.
+
+    The stream is copied without re-encoding, so every chunk starts at a
+    keyframe and the chunks together contain each frame exactly once.
 
+    Args:
+        video_file: string describing the path to the video file.
+        chunk_path: directory in which to write the chunks.
+        seconds: target length of each chunk in seconds.
+    Returns:
+        list of the paths of the chunks, in order.
+    """
+    with open(os.devnull, 'w') as devnull:
+        with timed("split", bytes_read=file_size(video_file)):
+            subprocess.run(["ffmpeg", "-i", video_file, "-map", "0:v:0",
+                            "-c", "copy", "-f", "segment", "-segment_time",
+                            str(seconds), "-reset_timestamps", "1",
+                            join(chunk_path, "chunk%04d.mp4")],
+                           stdout=devnull, stderr=devnull, check=True)
+
+    return sorted(join(chunk_path, x) for x in os.listdir(chunk_path)
+                  if x.endswith(".mp4"))
+
+
+def run_chunk(chunk_file, args):
+    """Annotate one chunk of a video, returning the path of its json file.
+
+    The annotator pipeline is loaded once per worker process.
+    """
+    json_file = chunk_file[:-4] + "-dvt.jsonl"
+    vproc = get_persistent_processor(args)
+    process_video(vproc, chunk_file, json_file, None, args)
+
+    return json_file
+
+
+def stitch_chunks(chunk_files, json_file, video_name):
+    """Join the json files of the chunks of a video into one file.
+
+    Frame numbers are shifted by the number of frames in the preceding
+    chunks, and the video line of the first chunk is kept with the name
+    and total frame count of the whole video. Since no chunk sees the
+    frame before its start, the first frame of each chunk has no diff
+    annotation, as for the first frame of the video.
+
+    Args:
+        chunk_files: iterable of the paths of the chunk json files, in
+            order; they are read as they become available.
+        json_file: path of the output json file.
+        video_name: file name of the whole video.
+    Returns:
+        the first frame of each chunk in the whole video, followed by the
+        total number of frames.
+    """
+    offset = 0
+    starts = []
+    video = None
+    tmp_file = json_file + ".tmp"
+    with open(tmp_file, "w") as fout:
+        for chunk_file in chunk_files:
+            starts.append(offset)
+            frames = 0
+            for line in iter_jsonl(chunk_file):
+                if line['type'] == "video":
+                    video = video or line
+                    continue
+                if line['type'] == "frame":
+                    frames = max(frames, line['frame'] + 1)
+                    line['frame'] += offset
+                fout.write(json.dumps(line) + "\n")
+            offset += frames
+
+    # the video line is written first, once the total is known
+    video = dict(video or {'type': "video"}, video=video_name, frames=offset)
+    with open(json_file, "w") as fout:
+        fout.write(json.dumps(video) + "\n")
+        with open(tmp_file, "r") as fin:
+            for line in fin:
+                fout.write(line)
+    os.remove(tmp_file)
+
+    return starts + [offset]
+
+
+def process_video_chunked(video_file, json_file, args):
+    """Run the dvt pipeline over chunks of a video in parallel.
+
+    The video is split into chunks of --chunk-seconds seconds, which are
+    annotated by --chunk-jobs worker processes. Finished chunks are
+    stitched into the output in frame order while later chunks are still
+    being annotated.
+
+    Returns:
+        the first frame of each chunk, as from stitch_chunks.
+    """
+    os.makedirs(os.path.dirname(json_file), exist_ok=True)
+
+    if args.resume:
+        return process_chunks_resumable(video_file, json_file, args)
 
-def get_args():
-    """Return the argument parser for this script.
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(json_file)) as tmp:
+        chunks = split_video(video_file, tmp, args.chunk_seconds)
+        return run_chunks(chunks, video_file, json_file, args)
+
+
+def run_chunks(chunks, video_file, json_file, args, done=(), callback=None):
+    """Annotate chunks in worker processes and stitch them in order.
+
+    Chunks in 'done' already have their json file and are not annotated
+    again; 'callback' is called with each chunk that finishes. Returns
+    the first frame of each chunk, as from stitch_chunks.
+    """
+    with timed("dvt", bytes_read=file_size(video_file)) as counts:
+        with ProcessPoolExecutor(max_workers=args.chunk_jobs) as executor:
+            futures = []
+            for chunk in chunks:
+                if chunk in done:
+                    futures.append(None)
+                    continue
+                futures.append(executor.submit(run_chunk, chunk, args))
+                if callback is not None:
+                    futures[-1].add_done_callback(
+                        functools.partial(_chunk_done, chunk, callback))
+            starts = stitch_chunks(
+                (chunk[:-4] + "-dvt.jsonl" if fut is None else fut.result()
+                 for chunk, fut in zip(chunks, futures)),
+                json_file, os.path.basename(video_file))
+        counts['items'] = starts[-1]
+        counts['bytes_written'] = file_size(json_file)
+
+    return starts[:-1]
+
+
+def _chunk_done(chunk, callback, future):
+    if future.exception() is None:
+        callback(chunk)
+
+
+def get_checkpoint_key(video_file, args):
+    """Return what must be unchanged for a checkpoint to be resumed.
+    """
+    stat = os.stat(video_file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'version': STAGE_VERSION, 'sampling': get_sampling(args),
+            'chunk_seconds': args.chunk_seconds}
+
+
+def process_chunks_resumable(video_file, json_file, args):
+    """Annotate the chunks of a video, keeping finished chunks on disk.
+
+    The chunks and their json files are kept in a directory next to the
+    json file, with a checkpoint listing the finished chunks. A run that
+    is interrupted only repeats the chunks that were not finished. The
+    directory is removed once the chunks have been stitched. Returns the
+    first frame of each chunk, as from stitch_chunks.
+    """
+    chunk_path = json_file[:-6] + "-chunks"
+    ckpt_file = join(chunk_path, "checkpoint.json")
+    key = get_checkpoint_key(video_file, args)
+
+    ckpt = {}
+    if os.path.isfile(ckpt_file):
+        with open(ckpt_file, "r") as fin:
+            ckpt = json.load(fin)
+    if ckpt.get('key') != key:
+        if os.path.exists(chunk_path):
+            shutil.rmtree(chunk_path)
+        os.makedirs(chunk_path)
+        chunks = split_video(video_file, chunk_path, args.chunk_seconds)
+        ckpt = {'key': key, 'chunks': [os.path.basename(x) for x in chunks],
+                'done': []}
+        update_json(ckpt_file, lambda data: data.update(ckpt))
+
+    chunks = [join(chunk_path, x) for x in ckpt['chunks']]
+    done = {join(chunk_path, x) for x in ckpt['done']}
+    if args.verbose and done:
+        print("Resuming {0:s} with {1:d} of {2:d} chunks done".format(
+            os.path.basename(video_file), len(done), len(chunks)))
+
+    def record(chunk):
+        update_json(ckpt_file, lambda data: data['done'].append(
+            os.path.basename(chunk)))
+
+    starts = run_chunks(chunks, video_file, json_file, args, done, record)
+    shutil.rmtree(chunk_path)
+
+    return starts
+
+
+def _is_frame_prefix(json_file):
+    # the frame lines are numbered 0, 1, 2, ... without gaps, as they are
+    # when dvt writes each frame as soon as it has been annotated
+    _, frames = build_jsonl_index(json_file)
+    frames = frames[frames >= 0]
+
+    return bool(np.array_equal(frames, np.arange(len(frames))))
+
+
+def process_video_resumable(vproc, video_file, json_file, frame_path, args):
+    """Run a VideoProcessor, continuing an interrupted run if possible.
+
+    A checkpoint file next to the json file records the video and options
+    of the run. When it matches, any incomplete last line of the json
+    file is removed and only the frames after the last complete frame
+    are annotated, as in resume_video. The run starts over when the json
+    file does not hold an unbroken run of frames from the start of the
+    video, or when the resumed frames do not line up with it. The
+    checkpoint is removed when the run is complete.
+    """
+    ckpt_file = json_file + ".ckpt"
+    key = get_checkpoint_key(video_file, args)
+
+    last = None
+    if os.path.isfile(ckpt_file) and os.path.isfile(json_file):
+        with open(ckpt_file, "r") as fin:
+            if json.load(fin) == key:
+                last = truncate_jsonl(json_file)
+        if last is not None and (last['type'] != "frame" or
+                                 not _is_frame_prefix(json_file)):
+            last = None
+
+    with open(ckpt_file, "w") as fout:
+        json.dump(key, fout)
+
+    if last is not None:
+        if args.verbose:
+            print("Resuming {0:s} from frame {1:d}".format(
+                os.path.basename(video_file), last['frame'] + 1))
+        if not resume_video(vproc, video_file, json_file, args, last):
+            last = None
+            if args.verbose:
+                print("Resumed frames of {0:s} do not match; starting "
+                      "over".format(os.path.basename(video_file)))
+    if last is None:
+        process_video(vproc, video_file, json_file, frame_path, args)
+
+    os.remove(ckpt_file)
+
+
+def resume_video(vproc, video_file, json_file, args, last):
+    """Annotate the frames of a video after the last written frame.
+
+    ffmpeg seeks to the keyframe before the last written frame and copies
+    the rest of the video stream, without decoding or encoding it, into a
+    temporary file. The frames from the keyframe onwards are annotated,
+    so the diff annotator sees the frame before the first new one, and
+    the new lines are appended to the json file with their frame numbers
+    shifted. The histogram of the last written frame is compared with
+    its new annotation to check that the frames line up.
+
+    Args:
+        vproc: the VideoProcessor object.
+        video_file: string describing the path to the video file.
+        json_file: string describing the path to the json file, which must
+            end with the line 'last'.
+        args: the arguments of this script.
+        last: dictionary of the last frame line of the json file.
+    Returns:
+        True if the remaining frames were appended, or False (leaving the
+        json file unchanged) if the frames do not line up.
+    """
+    rest_file = json_file[:-6] + "-rest.mkv"
+    rest_json = json_file[:-6] + "-rest.jsonl"
+    fps = probe_file(video_file)['fps']
+    try:
+        with open(os.devnull, 'w') as devnull:
+            with timed("seek"):
+                subprocess.run(["ffmpeg", "-y", "-ss", "{0:.6f}".format(
+                                    last['frame'] / fps),
+                                "-i", video_file, "-map", "0:v:0",
+                                "-c", "copy", "-copyts", rest_file],
+                               stdout=devnull, stderr=devnull, check=True)
+        first = int(round((get_first_pts(rest_file) -
+                           get_first_pts(video_file)) * fps))
+        if not 0 <= first <= last['frame']:
+            return False
+
+        process_video(vproc, rest_file, rest_json, None, args,
+                      start_frame=first)
+
+        lines = (x for x in iter_jsonl(rest_json) if x['type'] != "video")
+        for line in lines:
+            if line['type'] == "frame" and \
+                    line['frame'] + first == last['frame']:
+                break
+        else:
+            return False
+        if line.get('hist') != last.get('hist'):
+            return False
+
+        with open(json_file, "a") as fout:
+            for line in lines:
+                if line['type'] == "frame":
+                    line['frame'] += first
+                fout.write(json.dumps(line) + "\n")
+    finally:
+        for path in [rest_file, rest_json]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    return True
+
+
+def get_args(argv=None):
+    """Return the arguments of this script.
+
+    Args:
+        argv: list of command line arguments; defaults to sys.argv.
     """
     desc = 'Run distant viewing toolkit on raw mp4 files.'
     parser = default_option_parser(desc)
-    parser.add_argument('--frames', dest='png_flag', action='store_true')
+    parser.add_argument('--frames', dest='png_flag', action='store_true',
+                        help='write a png of every frame during annotation; '
+                             'script06_png.py exports frames faster')
+    parser.add_argument('--store', dest='store', action='store_true',
+                        help='also convert the output into a binary store')
     parser.add_argument('--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--persistent', dest='persistent',
+                        action='store_true',
+                        help='load the models once per process and reuse '
+                             'them for every episode')
+    parser.add_argument('--worker', dest='worker', action='store_true',
+                        help='run a persistent worker that processes '
+                             'episodes read from standard input')
+    parser.add_argument('--face-stride', dest='face_stride', type=int,
+                        default=1,
+                        help='only detect faces on every n-th frame, or '
+                             'with 0 only on the first frame of each shot')
+    parser.add_argument('--face-cuts', dest='face_cuts',
+                        action='store_true',
+                        help='also detect faces on the first frame of '
+                             'each shot when using --face-stride')
+    parser.add_argument('--two-pass', dest='two_pass', action='store_true',
+                        help='find the shots first and only detect faces '
+                             'on a few frames of each shot')
+    parser.add_argument('--shot-samples', dest='shot_samples', type=int,
+                        default=3,
+                        help='number of frames per shot searched for faces '
+                             'with --two-pass')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='continue interrupted episodes from the last '
+                             'frame or chunk that was finished')
+    parser.add_argument('--chunk-seconds', dest='chunk_seconds', type=int,
+                        default=0,
+                        help='split each video into chunks of this many '
+                             'seconds and annotate them in parallel')
+    parser.add_argument('--chunk-jobs', dest='chunk_jobs', type=int,
+                        default=2,
+                        help='number of chunks to annotate at once')
+
+    args = parser.parse_args(argv)
+    if args.face_stride < 0:
+        parser.error("--face-stride must not be negative")
+    if args.face_stride == 0 and not args.face_cuts:
+        parser.error("--face-stride 0 requires --face-cuts")
+    if args.two_pass and (args.face_stride != 1 or args.chunk_seconds):
+        parser.error("--two-pass cannot be used with --face-stride or "
+                     "--chunk-seconds")
+    if args.resume and (args.two_pass or args.png_flag):
+        parser.error("--resume cannot be used with --two-pass or --frames")
+    if args.chunk_seconds and args.png_flag:
+        parser.error("--frames cannot be used with --chunk-seconds")
+
+    return args
+
+
+def run_episode(episode, args):
+    """Run the dvt pipeline over a single episode.
+
+    The episode is skipped when the manifest shows that its json file is
+    up to date, unless the --force flag is given.
+    """
+    paths = get_io_paths(episode)
+
+    video_file = paths['ifile']
+    json_file = join(paths['spath'], episode + "-dvt.jsonl")
+    frame_path = paths['fpath']
+
+    params = {'frames': args.png_flag}
+    if args.chunk_seconds:
+        params['chunk_seconds'] = args.chunk_seconds
+    sampling = get_sampling(args)
+    if sampling:
+        params['sampling'] = sampling
+    if args.two_pass:
+        params['shot_samples'] = args.shot_samples
+        sampling = {'face': {'stride': 0, 'dval_cut': None,
+                             'per_shot': args.shot_samples,
+                             'propagated': True}}
+
+    outputs = [json_file]
+    if args.store:
+        outputs.append(join(get_store_path(json_file), "meta.json"))
+    if sampling:
+        outputs.append(get_sampling_path(json_file))
 
-    return parser.parse_args()
+    manifest = get_manifest(episode.split("-")[0])
+    if not args.force and manifest.is_current(
+            "dvt", episode, [video_file], outputs, STAGE_VERSION, params):
+        if args.verbose:
+            print("Skipping {0:s}; up to date".format(episode))
+        return
+
+    if args.chunk_seconds:
+        starts = process_video_chunked(video_file, json_file, args)
+        if sampling:
+            # the stride restarts at the first frame of each chunk
+            sampling = {key: dict(value, chunk_starts=starts)
+                        for key, value in sampling.items()}
+    elif args.two_pass and (args.persistent or args.worker):
+        process_video_two_pass(video_file, json_file, frame_path, args)
+    elif args.persistent or args.worker:
+        vproc = get_persistent_processor(args)
+        if args.resume:
+            process_video_resumable(vproc, video_file, json_file,
+                                    frame_path, args)
+        else:
+            process_video(vproc, video_file, json_file, frame_path, args)
+    else:
+        from keras import backend as K
+
+        if args.two_pass:
+            process_video_two_pass(video_file, json_file, frame_path, args)
+        elif args.resume:
+            vproc = get_processor(args)
+            process_video_resumable(vproc, video_file, json_file,
+                                    frame_path, args)
+        else:
+            vproc = get_processor(args)
+            process_video(vproc, video_file, json_file, frame_path, args)
+
+        K.clear_session()   # garbage collect for GPU memory
+
+    set_sampling(json_file, sampling)
+
+    with timed("index", bytes_read=file_size(json_file)) as counts:
+        _, frames = build_jsonl_index(json_file)
+        counts['items'] = int((frames >= 0).sum())
+    if args.store:
+        with timed("store", bytes_read=file_size(json_file)):
+            write_store(json_file)
+
+    manifest.record("dvt", episode, [video_file], outputs, STAGE_VERSION,
+                    params)
 
 
 def run_pipeline():
@@ -82,20 +821,38 @@ def run_pipeline():
     """
     args = get_args()
 
-    from keras import backend as K
+    if args.worker:
+        run_worker(args)
+        return
 
-    for episode in get_episodes(args):
-        vproc = get_processor(args)
+    failed = run_episodes(functools.partial(run_episode, args=args),
+                          get_episodes(args), jobs=args.jobs,
+                          verbose=args.verbose, metrics=args.metrics,
+                          profile=args.profile)
+    if failed:
+        sys.exit(1)
 
-        paths = get_io_paths(episode)
 
-        video_file = paths['ifile']
-        json_file = join(paths['spath'], episode + "-dvt.jsonl")
-        frame_path = paths['fpath']
+def run_worker(args):
+    """Process a stream of episodes read from standard input.
 
-        process_video(vproc, video_file, json_file, frame_path, args)
+    The annotator pipeline is loaded before the first job arrives and kept
+    for the lifetime of the worker; only the per-video state is reset
+    between episodes. The worker exits when standard input is closed,
+    with a non-zero status if any episode failed.
+    """
+    if args.two_pass:
+        get_persistent_processor(args, get_shot_processor)
+        get_persistent_processor(args, get_face_processor)
+    else:
+        get_persistent_processor(args)
 
-        K.clear_session()   # garbage collect for GPU memory
+    episodes = (x.strip() for x in sys.stdin)
+    failed = run_episodes(functools.partial(run_episode, args=args),
+                          (x for x in episodes if x), verbose=args.verbose,
+                          metrics=args.metrics, profile=args.profile)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -4,29 +4,49 @@
 This callable module is used to compute fingerprint files (canonical faces
 in the embedding space) for a series.
 
+When the series has an exemplar file, model/fprint/<series>-exemplars.csv,
+the face index of the series is built from it. Each row of the file names
+one labelled face, with the columns series, episode, frame, face and
+label, where face is the position of the face within the frame. Any
+number of exemplars may be given for each label. Otherwise the legacy
+fingerprint pickle file is created from exemplars fixed in the code.
+
 Example:
     To process the fingerprint file for Bewitched, run the following:
 
         $ python3 script04_fingerprint.py --series bw
 """
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import functools
 import os
+from os.path import join
 import pickle
 
-from utils import default_option_parser, read_user_properties, load_jsonl, \
-                  norm_array
+import numpy as np
+
+from dvtstore import DvtStore, get_store_path, load_dvt
+# get_fprint_path and stack_fprint used to be defined here; they are
+# imported so that existing imports from this module keep working
+from faceindex import FaceIndex, get_fprint_path, get_index_path, \
+                      stack_fprint  # noqa: F401
+from utils import default_option_parser, get_io_paths, iter_jsonl, \
+                  read_user_properties, norm_array
 
 
 def get_fprint(series):
     """Create of load fingerprint file for a series.
+
+    Exemplar frames are read from the binary dvt store of an episode when
+    one exists, and from its jsonl file otherwise.
     """
     base = read_user_properties()['basepath']
-    fdir = os.path.join(base, "model", "fprint")
-    fprint_file = os.path.join(fdir, series + "fingerprint.pickle")
+    fprint_file = get_fprint_path(series)
 
     if not os.path.exists(fprint_file):
         if series == "bw":
-            jsl = load_jsonl(base + "/stage/bw/bw-s02-e02-dvt.jsonl")
-            js2 = load_jsonl(base + "/stage/bw/bw-s07-e02-dvt.jsonl")
+            jsl = load_dvt(base + "/stage/bw/bw-s02-e02-dvt.jsonl")
+            js2 = load_dvt(base + "/stage/bw/bw-s07-e02-dvt.jsonl")
             fprint = {'larry': norm_array(jsl[7921]['face'][0]['embed']),
                       'darrin': norm_array(jsl[8501]['face'][0]['embed']),
                       'sam': norm_array(jsl[12031]['face'][0]['embed']),
@@ -34,14 +54,14 @@ def get_fprint(series):
                       'darrin2': norm_array(js2[21141]['face'][0]['embed'])}
 
         elif series == "idoj":
-            jsl = load_jsonl(base + "/stage/idoj/idoj-s02-e02-dvt.jsonl")
+            jsl = load_dvt(base + "/stage/idoj/idoj-s02-e02-dvt.jsonl")
             fprint = {'tony': norm_array(jsl[4411]['face'][0]['embed']),
                       'alfred': norm_array(jsl[15391]['face'][0]['embed']),
                       'jeannie': norm_array(jsl[6671]['face'][0]['embed']),
                       'roger': norm_array(jsl[4301]['face'][0]['embed'])}
 
         elif series == "friends":
-            jsl = load_jsonl(base + "/stage/friends/friends-s02-e03-dvt.jsonl")
+            jsl = load_dvt(base + "/stage/friends/friends-s02-e03-dvt.jsonl")
             fprint = {'monica': norm_array(jsl[12081]['face'][0]['embed']),
                       'chandler': norm_array(jsl[18431]['face'][0]['embed']),
                       'rachel': norm_array(jsl[15951]['face'][0]['embed']),
@@ -63,14 +83,147 @@ def get_fprint(series):
     return fprint
 
 
+def get_exemplars_path(series):
+    """Return the path to the exemplar file for a series.
+    """
+    base = read_user_properties()['basepath']
+    return join(base, "model", "fprint", series + "-exemplars.csv")
+
+
+def read_exemplars(path, series):
+    """Read the exemplars of a series, grouped by episode.
+
+    Args:
+        path: string describing the path to the exemplar csv file.
+        series: string describing the series; rows of other series are
+            ignored.
+    Returns:
+        a dictionary mapping each episode to a list of (frame, face,
+        label) tuples.
+    """
+    exemplars = {}
+    with open(path, "r", newline="") as fin:
+        for row in csv.DictReader(fin):
+            if row['series'] != series:
+                continue
+            exemplars.setdefault(row['episode'], []).append(
+                (int(row['frame']), int(row['face']), row['label']))
+
+    return exemplars
+
+
+def _read_frames(json_file, numbers):
+    # return the face lists of the given frame numbers; the binary store
+    # is used when it exists, and otherwise the jsonl file is read in a
+    # single pass that stops once every frame has been found
+    store_path = get_store_path(json_file)
+    if os.path.isfile(join(store_path, "meta.json")):
+        store = DvtStore(store_path)
+        rows = np.flatnonzero(np.isin(store.frame, list(numbers)))
+        return {int(store.frame[x]): store.frame_line(x).get('face', [])
+                for x in rows}
+
+    found = {}
+    for line in iter_jsonl(json_file):
+        if line['type'] == "frame" and line['frame'] in numbers:
+            found[line['frame']] = line.get('face', [])
+            if len(found) == len(numbers):
+                break
+
+    return found
+
+
+def get_episode_exemplars(episode, exemplars):
+    """Return the labels and embeddings of the exemplars of one episode.
+
+    Args:
+        episode: string describing the episode.
+        exemplars: list of (frame, face, label) tuples.
+    Returns:
+        tuple of a list of labels and a list of embeddings.
+    """
+    json_file = join(get_io_paths(episode)['spath'], episode + "-dvt.jsonl")
+    faces = _read_frames(json_file, {x[0] for x in exemplars})
+
+    labels = []
+    embeds = []
+    for frame, face, label in exemplars:
+        if frame not in faces or face >= len(faces[frame]):
+            raise ValueError("No face {0:d} in frame {1:d} of {2:s}".format(
+                face, frame, episode))
+        labels.append(label)
+        embeds.append(np.asarray(faces[frame][face]['embed'],
+                                 dtype=np.float32))
+
+    return labels, embeds
+
+
+def _get_exemplars(episode, exemplars):
+    return get_episode_exemplars(episode, exemplars[episode])
+
+
+def build_face_index(series, path=None, jobs=1):
+    """Build and save the face index of a series from its exemplar file.
+
+    The episodes named in the exemplar file are read in parallel, each
+    one only once.
+
+    Args:
+        series: string describing the series.
+        path: path to the exemplar file; by default get_exemplars_path.
+        jobs: number of episodes to read at once.
+    Returns:
+        the FaceIndex object, which is also saved to get_index_path.
+    """
+    if path is None:
+        path = get_exemplars_path(series)
+    exemplars = read_exemplars(path, series)
+    episodes = sorted(exemplars)
+
+    func = functools.partial(_get_exemplars, exemplars=exemplars)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(func, episodes))
+    else:
+        results = [func(x) for x in episodes]
+
+    labels = [x for res in results for x in res[0]]
+    embeds = [x for res in results for x in res[1]]
+    findex = FaceIndex(labels, np.array(embeds, ndmin=2))
+    findex.save(get_index_path(series))
+
+    return findex
+
+
 def get_args():
     """Run module with the desired options.
     """
     desc = 'Create fingerprint files.'
     parser = default_option_parser(desc)
+    parser.add_argument('--exemplars', dest='exemplars', default=None,
+                        help='exemplar csv file; by default '
+                             'model/fprint/<series>-exemplars.csv')
+
+    args = parser.parse_args()
+    if args.exemplars and not os.path.isfile(args.exemplars):
+        parser.error("no exemplar file at " + args.exemplars)
+
+    return args
+
 
-    return parser.parse_args()
+def run_fingerprint():
+    """Build the face index or fingerprint file of the selected series.
+    """
+    args = get_args()
+
+    path = args.exemplars or get_exemplars_path(args.series)
+    if os.path.isfile(path):
+        findex = build_face_index(args.series, path, jobs=args.jobs)
+        print("Wrote {0:d} exemplars of {1:d} labels to {2:s}".format(
+            len(findex), len(findex.labels), get_index_path(args.series)))
+    else:
+        get_fprint(args.series)
 
 
 if __name__ == "__main__":
-    get_fprint(get_args().series)
+    run_fingerprint()
@@ -3,7 +3,8 @@
 
 This callable module is used to convert the jsonl files from the distant
 viewing module into csv files. You can select the series and (optionally)
-the season and episodes using command line arguments.
+the season and episodes using command line arguments. Use the --format
+option to write parquet or feather files instead of csv.
 
 Example:
     To process the first 5 episodes from season 2 of Bewitched,
@@ -12,82 +13,195 @@ Example:
         $ python3 script05_process_json.py --series bw --season 2 \
                                            --episode 1 2 3 4 5
 """
+from array import array
+import functools
 import logging
 import os
 from os.path import join
-import pickle
-import re
-import subprocess
+import sys
 
 import numpy as np
 import pandas as pd
 
-from utils import default_option_parser, get_episodes, get_io_paths, \
-                  load_jsonl, norm_array, read_user_properties
+from aggregate import AGGREGATES, EpisodeAggregator, get_aggregate_path, \
+                      update_aggregates
+from dvtstore import DvtStore, get_store_path, iter_dvt, read_sampling
+from faceindex import METHODS, UNKNOWN, FaceIndex, get_index_input, \
+                      load_face_index
+from manifest import get_manifest
+from probe import get_probe_cache_path, probe_file, probe_many
+from subtitles import read_subtitles
+from tables import FORMATS, TableWriter, get_table_path, write_table
+from utils import default_option_parser, file_size, get_episodes, \
+                  get_io_paths, run_episodes, timed
+
+STAGE_VERSION = 1
+CHUNK_SIZE = 5000
+DVAL_CUT = 12
+HVAL_CUT = 4000
+MIN_GAP = 12
+
+VIDEO_COLUMNS = ["video", "fps", "frames", "width", "height", "face_stride"]
+FRAME_COLUMNS = ["video", "frame", "sid", "dval", "hval"]
+SHOTS_COLUMNS = ["video", "frame_start", "frame_stop", "sid"]
+FACES_COLUMNS = ["video", "frame", "sid", "character", "top", "bottom",
+                 "left", "right", "score", "overlap"]
+YOLOS_COLUMNS = ["video", "frame", "sid", "class", "top", "bottom", "left",
+                 "right", "score"]
+
+
+class ColumnBuffer():
+    """Accumulate the rows of a table in typed arrays, one per column.
+
+    Each column is an array.array with the given type code, which grows
+    geometrically as rows are appended and stores numbers without a Python
+    object per value. String columns hold integer codes into a list of
+    categories, and columns with type code 'b' are returned as booleans.
+    The video name is the same for every row of a table and is only added
+    when the DataFrame is built.
+    """
+    def __init__(self, columns):
+        self.columns = columns
+        self.arrays = {}
+        self.clear()
+
+    def __len__(self):
+        return len(next(iter(self.arrays.values())))
+
+    def append(self, *values):
+        """Append one row, with values in the order of the columns.
+
+        Values of boolean columns are converted with bool, so any number
+        may be given.
+        """
+        for arr, value in zip(self.arrays.values(), values):
+            arr.append(bool(value) if arr.typecode == 'b' else value)
+
+    def extend(self, *columns):
+        """Append many rows, given as one sequence or array per column.
+        """
+        for arr, values in zip(self.arrays.values(), columns):
+            values = np.asarray(values)
+            if arr.typecode == 'b':
+                values = values != 0
+            arr.frombytes(values.astype(arr.typecode).tobytes())
+
+    def clear(self):
+        """Remove all rows.
+        """
+        self.arrays = {key: array(code) for key, code in self.columns.items()}
+
+    def to_frame(self, video, columns, categories=None):
+        """Return the rows as a pandas DataFrame.
+
+        Args:
+            video: name of the video, repeated in the 'video' column.
+            columns: list giving the order of the output columns.
+            categories: dictionary mapping the name of each string column
+                to the list of values that its codes refer to.
+        Returns:
+            a pandas DataFrame with one row per appended row.
+        """
+        data = {key: np.frombuffer(arr, dtype=arr.typecode) if arr else
+                np.zeros(0, dtype=arr.typecode)
+                for key, arr in self.arrays.items()}
+        for key, arr in self.arrays.items():
+            if arr.typecode == 'b':
+                data[key] = data[key].astype(bool)
+        for key, values in (categories or {}).items():
+            data[key] = np.asarray(values, dtype=object)[data[key]]
+        data['video'] = np.full(len(self), video, dtype=object)
+
+        return pd.DataFrame(data, columns=columns)
 
 
 class JsonProcessor():
     """Load and process json files.
+
+    The path may point either to a dvt jsonl file or to a binary store
+    created by dvtstore.write_store. A new shot starts at frames whose
+    median diff exceeds 'dval_cut' and histogram distance to the previous
+    frame exceeds 'hval_cut', at least 'min_gap' frames after the last
+    cut. Faces are matched against 'fprint', either a fingerprint
+    dictionary or a FaceIndex. When script03 only detected faces on some
+    of the frames, the sampling is read from its sampling file and the
+    'face_stride' of the video table gives the sampling interval (zero
+    when faces were only detected on a few frames of each shot).
+
+    By default the whole file is parsed when the object is created. Set
+    'stream' to True to defer parsing; the rows are then produced in
+    bounded chunks by the 'stream' method.
     """
-    def __init__(self, path, fprint):
-        self.fprint = fprint
+    def __init__(self, path, fprint, stream=False, dval_cut=DVAL_CUT,
+                 hval_cut=HVAL_CUT, min_gap=MIN_GAP):
+        self.path = path
+        self.dval_cut = dval_cut
+        self.hval_cut = hval_cut
+        self.min_gap = min_gap
+        self.findex = fprint if isinstance(fprint, FaceIndex) else \
+            FaceIndex.from_fprint(fprint)
+        self.embeds = []
         self.video = "unknown"
         self.sid = 0
         self.last_frame = 0
         self.last_hist = np.zeros((16 * 3,), dtype=np.int64)
         self.data = None
-        self.output = dict(frame=[], shots=[], faces=[], yolos=[], meta={})
-
-        self.load(path)
-
-    def _get_character(self, embed):
-        embed = norm_array(embed)
-        nssim = -1
-        nchar = "unknown"
-
-        for key, val in self.fprint.items():
-            tsim = np.sum(val * embed)
-            if tsim > nssim:
-                nssim = tsim
-                nchar = key
-
-        return nssim, nchar
+        self.classes = {}
+        # box coordinates are floats, as dvt may give scaled coordinates
+        self.output = dict(
+            frame=ColumnBuffer({'frame': 'q', 'sid': 'q', 'dval': 'd',
+                                'hval': 'd'}),
+            shots=ColumnBuffer({'frame_start': 'q', 'frame_stop': 'q',
+                                'sid': 'q'}),
+            faces=ColumnBuffer({'frame': 'q', 'sid': 'q', 'character': 'q',
+                                'top': 'd', 'bottom': 'd', 'left': 'd',
+                                'right': 'd', 'score': 'd', 'overlap': 'b'}),
+            yolos=ColumnBuffer({'frame': 'q', 'sid': 'q', 'class': 'q',
+                                'top': 'd', 'bottom': 'd', 'left': 'd',
+                                'right': 'd', 'score': 'd'}),
+            meta={})
+
+        if not stream:
+            self.load(path)
+
+    def _assign_characters(self):
+        # faces are matched in bulk whenever rows are handed back, with one
+        # matrix product against the fingerprint for all pending embeddings
+        if not self.embeds:
+            return
+
+        with timed("match", items=len(self.embeds)):
+            scores, codes = self.findex.query(np.array(self.embeds))
+        faces = self.output['faces'].arrays
+        faces['score'][-len(scores):] = array('d', scores.tolist())
+        faces['character'][-len(codes):] = array('q', codes.tolist())
+        self.embeds = []
 
     def _add_faces(self, line, frame):
 
         for face in line['face']:
-            score, cname = self._get_character(face['embed'])
-            self.output['faces'].append({"video": self.video,
-                                         "frame": frame,
-                                         "sid": self.sid,
-                                         "character": cname,
-                                         "top": face['box']['top'],
-                                         "bottom": face['box']['bottom'],
-                                         "left": face['box']['left'],
-                                         "right": face['box']['right'],
-                                         "score": score,
-                                         "overlap": face['hog_overlap']})
+            self.embeds.append(face['embed'])
+            self.output['faces'].append(frame, self.sid, -1,
+                                        face['box']['top'],
+                                        face['box']['bottom'],
+                                        face['box']['left'],
+                                        face['box']['right'],
+                                        np.nan, face['hog_overlap'])
 
     def _add_frame(self, frame, dval, hval):
 
-        self.output['frame'].append({"video": self.video,
-                                     "frame": frame,
-                                     "sid": self.sid,
-                                     "dval": dval,
-                                     "hval": hval})
+        self.output['frame'].append(frame, self.sid, dval, hval)
 
     def _add_objects(self, line, frame):
 
         for obj in line['object']:
-            self.output['yolos'].append({"video": self.video,
-                                         "frame": frame,
-                                         "sid": self.sid,
-                                         "class": obj['class'],
-                                         "top": obj['box']['top'],
-                                         "bottom": obj['box']['bottom'],
-                                         "left": obj['box']['left'],
-                                         "right": obj['box']['right'],
-                                         "score": obj['score']})
+            code = self.classes.setdefault(obj['class'], len(self.classes))
+            self.output['yolos'].append(frame, self.sid, code,
+                                        obj['box']['top'],
+                                        obj['box']['bottom'],
+                                        obj['box']['left'],
+                                        obj['box']['right'],
+                                        obj['score'])
 
     def _process_frame(self, line):
 
@@ -100,174 +214,544 @@ class JsonProcessor():
         else:
             dval = 0
         self._add_frame(frame, dval, hval)
-        if dval > 12 and hval > 4000:
-            if frame - self.last_frame > 12:
-                self.output['shots'].append({"video": self.video,
-                                             "frame_start": self.last_frame,
-                                             "frame_stop": frame - 1,
-                                             "sid": self.sid})
+        if dval > self.dval_cut and hval > self.hval_cut:
+            if frame - self.last_frame > self.min_gap:
+                self.output['shots'].append(self.last_frame, frame - 1,
+                                            self.sid)
                 self.last_frame = frame
-                print("Finished scene number {0:03d}.".format(self.sid))
+                logging.debug("Finished scene number %03d.", self.sid)
                 self.sid = self.sid + 1
         if 'object' in line:
             self._add_objects(line, frame)
         if 'face' in line:
             self._add_faces(line, frame)
 
+    def _process_line(self, line):
+
+        if line['type'] == "video":
+            self.video = line['video']
+            self.output['meta'] = line
+        if line['type'] == "frame":
+            self._process_frame(line)
+
+    def _flush(self):
+
+        self._assign_characters()
+        out = self.output
+        with timed("dataframe", items=len(out['frame'])):
+            tables = (
+                out['frame'].to_frame(self.video, FRAME_COLUMNS),
+                out['shots'].to_frame(self.video, SHOTS_COLUMNS),
+                out['faces'].to_frame(
+                    self.video, FACES_COLUMNS,
+                    {'character': self.findex.labels + [UNKNOWN]}),
+                out['yolos'].to_frame(
+                    self.video, YOLOS_COLUMNS,
+                    {'class': sorted(self.classes, key=self.classes.get)}))
+        for key in ['frame', 'shots', 'faces', 'yolos']:
+            out[key].clear()
+
+        return tables
+
+    def _open_store(self, store):
+        # take the video line and object classes from the store metadata
+        if store.meta['video'] is not None:
+            self._process_line(store.meta['video'])
+        self.classes = {name: code for code, name in
+                        enumerate(store.meta['classes'])}
+
+    def _process_rows(self, store, start, stop):
+        # process rows [start, stop) of a binary store, working on the
+        # memory mapped columns rather than on one dictionary per frame
+        if stop <= start:
+            return
+
+        frames = np.asarray(store.frame[start:stop])
+        hist = np.asarray(store.hist[start:stop], dtype=np.int64)
+        dval = np.zeros(len(frames))
+        if store.diff.shape[1] > 5:
+            dval = np.where(store.has_diff[start:stop],
+                            store.diff[start:stop, 5], 0)
+
+        prev = np.vstack([self.last_hist[None, :], hist[:-1]])
+        hval = np.mean(np.abs(prev - hist), axis=1)
+        if len(hist):
+            self.last_hist = hist[-1]
+
+        # only the candidate cuts are checked against the minimum gap
+        cuts = []
+        for idx in np.flatnonzero((dval > self.dval_cut) &
+                                  (hval > self.hval_cut)):
+            if frames[idx] - self.last_frame > self.min_gap:
+                self.output['shots'].append(self.last_frame,
+                                            int(frames[idx]) - 1,
+                                            self.sid + len(cuts))
+                self.last_frame = int(frames[idx])
+                cuts.append(idx)
+        # a cut frame still belongs to the previous shot, but its faces and
+        # objects are counted in the new one
+        rows = np.arange(len(frames))
+        self.output['frame'].extend(
+            frames, self.sid + np.searchsorted(cuts, rows, side='left'),
+            dval, hval)
+        sid = self.sid + np.searchsorted(cuts, rows, side='right')
+        self.sid += len(cuts)
+
+        first, last = store.object_offset[start], store.object_offset[stop]
+        rows = np.repeat(np.arange(len(frames)),
+                         np.diff(store.object_offset[start:stop + 1]))
+        box = store.object_box[first:last]
+        self.output['yolos'].extend(frames[rows], sid[rows],
+                                    store.object_class[first:last],
+                                    *box.T, store.object_score[first:last])
+
+        first, last = store.face_offset[start], store.face_offset[stop]
+        rows = np.repeat(np.arange(len(frames)),
+                         np.diff(store.face_offset[start:stop + 1]))
+        if last > first:
+            with timed("match", items=last - first):
+                scores, codes = self.findex.query(
+                    store.face_embed[first:last])
+        else:
+            scores, codes = np.zeros(0), np.zeros(0, dtype=np.int64)
+        box = store.face_box[first:last]
+        self.output['faces'].extend(frames[rows], sid[rows], codes, *box.T,
+                                    scores, store.face_overlap[first:last])
+
     def load(self, path):
         """Load json data from file located at 'path'.
+
+        A binary store is processed column by column from its memory
+        mapped arrays; a jsonl file is parsed line by line.
+        """
+        if os.path.isdir(path):
+            store = DvtStore(path)
+            self._open_store(store)
+            with timed("frames", items=len(store.frame)):
+                self._process_rows(store, 0, len(store.frame))
+            return
+
+        with timed("parse", bytes_read=file_size(path)) as counts:
+            self.data = list(iter_dvt(path))
+            counts['items'] = len(self.data)
+        with timed("frames", items=len(self.data)):
+            for line in self.data:
+                self._process_line(line)
+
+    def stream(self, chunk_size=CHUNK_SIZE):
+        """Lazily process the json file, yielding tuples of DataFrames.
+
+        Lines are read one at a time and the accumulated rows are handed
+        back every 'chunk_size' frames, so memory usage does not grow
+        with the length of the episode.
+
+        Args:
+            chunk_size: number of frames to process between chunks.
+        Returns:
+            a generator of (frame, shots, faces, yolos) DataFrame tuples.
+        """
+        if os.path.isdir(self.path):
+            store = DvtStore(self.path)
+            self._open_store(store)
+            for start in range(0, max(len(store.frame), 1), chunk_size):
+                stop = min(start + chunk_size, len(store.frame))
+                with timed("frames", items=stop - start):
+                    self._process_rows(store, start, stop)
+                yield self._flush()
+            return
+
+        lines = iter_dvt(self.path)
+        finished = False
+        while not finished:
+            with timed("frames") as counts:
+                finished = True
+                for line in lines:
+                    self._process_line(line)
+                    if line['type'] == "frame":
+                        counts['items'] += 1
+                        if counts['items'] == chunk_size:
+                            finished = False
+                            break
+
+            yield self._flush()
+
+    def get_sampling(self):
+        """Return the face sampling recorded by script03, if any.
+
+        Files from earlier versions of script03 record the sampling in
+        the video line instead of in a sampling file.
         """
+        sampling = read_sampling(self.path)
+        if sampling is None:
+            sampling = self.output['meta'].get('sampling')
 
-        self.data = load_jsonl(path)
-        for line in self.data:
-            if line['type'] == "video":
-                self.video = line['video']
-                self.output['meta'] = line
-            if line['type'] == "frame":
-                self._process_frame(line)
+        return sampling
 
-    def get_data(self):
-        """Return of a tuple of pandas DataFrame objects.
+    def get_video(self):
+        """Return a pandas DataFrame describing the video metadata.
         """
 
-        video = pd.DataFrame({'video': [self.output['video']],
+        sampling = self.get_sampling() or {}
+        video = pd.DataFrame({'video': [self.video],
                               'fps': [self.output['meta']['fps']],
                               'frames': [self.output['meta']['frames']],
                               'width': [self.output['meta']['width']],
-                              'height': [self.output['meta']['height']]})
-        frame = pd.DataFrame(self.output['frame'])
-        shots = pd.DataFrame(self.output['shots'])
-        faces = pd.DataFrame(self.output['faces'])
-        yolos = pd.DataFrame(self.output['yolos'])
-
-        video = video[["video", "fps", "frames", "width", "height"]]
-        frame = frame[["video", "frame", "sid", "dval", "hval"]]
-        shots = shots[["video", "frame_start", "frame_stop", "sid"]]
-        faces = faces[["video", "frame", "sid", "character", "top", "bottom",
-                       "left", "right", "score", "overlap"]]
-        yolos = yolos[["video", "frame", "sid", "class", "top", "bottom",
-                       "left", "right", "score"]]
-        return video, frame, shots, faces, yolos
+                              'height': [self.output['meta']['height']],
+                              'face_stride': [sampling.get(
+                                  'face', {}).get('stride', 1)]})
+
+        return video[VIDEO_COLUMNS]
+
+    def get_data(self):
+        """Return of a tuple of pandas DataFrame objects.
+        """
+
+        return (self.get_video(),) + self._flush()
+
+
+def write_chunks(jprc, opaths, fmt="csv", chunk_size=CHUNK_SIZE,
+                 aggregator=None):
+    """Stream the output of a JsonProcessor into table files.
+
+    Args:
+        jprc: a JsonProcessor object created with 'stream' set to True.
+        opaths: list of four output paths, for the frame, shots, faces,
+            and yolos tables respectively.
+        fmt: output format; one of "csv", "parquet", or "feather".
+        chunk_size: number of frames to process between writes.
+        aggregator: optional EpisodeAggregator to which each chunk of the
+            frame and faces tables is added.
+    Returns:
+        None
+    """
+    writers = [TableWriter(opath, fmt) for opath in opaths]
+    try:
+        for tables in jprc.stream(chunk_size):
+            for writer, table in zip(writers, tables):
+                writer.write(table)
+            if aggregator is not None:
+                aggregator.add(tables[0], tables[2])
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def segment_shots(frames, hist, dval, dval_cut=DVAL_CUT, hval_cut=HVAL_CUT,
+                  min_gap=MIN_GAP):
+    """Split an episode into shots using whole-episode arrays.
+
+    Gives the same shots as JsonProcessor: the histogram distances of all
+    frames are computed at once and only the few candidate cuts are
+    checked against the minimum gap, which depends on the previous cut.
+
+    Args:
+        frames: array of frame numbers.
+        hist: matrix of HSV histograms, one row per frame.
+        dval: array of median diff values, one per frame.
+        dval_cut: minimum diff value at a cut.
+        hval_cut: minimum histogram distance at a cut.
+        min_gap: minimum number of frames between cuts.
+    Returns:
+        tuple of three arrays: the histogram distance and shot id of each
+        frame, and the row indices of the cut frames.
+    """
+    frames = np.asarray(frames)
+    hist = np.asarray(hist, dtype=np.float64)
+    dval = np.asarray(dval)
+
+    prev = np.zeros_like(hist)
+    prev[1:] = hist[:-1]
+    hval = np.mean(np.abs(prev - hist), axis=1)
+
+    cuts = []
+    last_frame = 0
+    for idx in np.flatnonzero((dval > dval_cut) & (hval > hval_cut)):
+        if frames[idx] - last_frame > min_gap:
+            cuts.append(idx)
+            last_frame = frames[idx]
+    cuts = np.array(cuts, dtype=np.int64)
+
+    # the cut frame itself still belongs to the previous shot
+    sid = np.searchsorted(cuts, np.arange(len(frames)), side='left')
+
+    return hval, sid, cuts
+
+
+def load_shot_signals(path):
+    """Return the arrays needed for shot segmentation from dvt output.
+
+    Args:
+        path: path to a dvt jsonl file or binary store.
+    Returns:
+        tuple of the video name, frame numbers, histogram matrix and
+        median diff values.
+    """
+    if os.path.isdir(path):
+        store = DvtStore(path)
+        dval = np.zeros(len(store.frame))
+        if store.diff.shape[1] > 5:
+            dval = np.where(store.has_diff, store.diff[:, 5], 0)
+        return store.meta['video']['video'], store.frame, store.hist, dval
+
+    video = "unknown"
+    frames, hist, dval = [], [], []
+    for line in iter_dvt(path):
+        if line['type'] == "video":
+            video = line['video']
+        if line['type'] == "frame":
+            frames.append(line['frame'])
+            hist.append(line['hist']['hsv'])
+            dval.append(line['diff']['decile'][5] if 'diff' in line else 0)
+
+    return video, np.array(frames), np.array(hist), np.array(dval)
+
+
+def get_shots(path, dval_cut=DVAL_CUT, hval_cut=HVAL_CUT, min_gap=MIN_GAP):
+    """Return the frame and shots DataFrames of an episode.
+
+    Uses the vectorized segment_shots rather than JsonProcessor, so that a
+    series can be quickly re-segmented with new thresholds.
+    """
+    with timed("parse", bytes_read=file_size(path)):
+        video, frames, hist, dval = load_shot_signals(path)
+    with timed("shots", items=len(frames)):
+        hval, sid, cuts = segment_shots(frames, hist, dval, dval_cut,
+                                        hval_cut, min_gap)
+
+    frame = pd.DataFrame({'video': video, 'frame': frames, 'sid': sid,
+                          'dval': dval, 'hval': hval}, columns=FRAME_COLUMNS)
+    stops = np.asarray(frames)[cuts]
+    shots = pd.DataFrame({'video': video,
+                          'frame_start': np.concatenate([[0], stops])[:-1],
+                          'frame_stop': stops - 1,
+                          'sid': np.arange(len(cuts))},
+                         columns=SHOTS_COLUMNS)
+
+    return frame, shots
 
 
 def get_chapter_breaks(vpath):
     """Return DataFrame of the chapter breaks.
+
+    The chapters are read from the probe cache of the series, running
+    ffprobe only if the video is new or has changed.
     """
     assert os.path.exists(vpath)
 
     vname = os.path.basename(vpath)[:-4]
-    psub = subprocess.Popen(['ffprobe', vpath],
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    _, err = psub.communicate()
-
-    merr = err.decode("utf-8").split("\n")
+    info = probe_file(vpath, get_probe_cache_path(vname))
 
-    start = []
-    end = []
-    chapters = [x for x in merr if re.match("    Chapter #0:[0-9]", x)]
-    for chap in chapters:
-        start.append(float(re.search(" start [0-9]+.[0-9]+",
-                                     chap).group(0)[7:]))
-        end.append(float(re.search(" end [0-9]+.[0-9]+", chap).group(0)[5:]))
-
-    dframe = pd.DataFrame({'video': vname, 'chapter': range(len(start)),
-                           'start': start, 'end': end})
-    dframe = dframe[['video', 'chapter', 'start', 'end']]
+    dframe = pd.DataFrame({'video': vname,
+                           'chapter': range(len(info['chapters'])),
+                           'start': [x['start'] for x in info['chapters']],
+                           'end': [x['end'] for x in info['chapters']]},
+                          columns=['video', 'chapter', 'start', 'end'])
 
     return dframe
 
 
-def _time_to_seconds(time):
-    hours = int(time[0:2])
-    minutes = int(time[3:5])
-    seconds = int(time[6:8])
-    msec = int(time[9:12])
-    return msec/1000 + seconds + minutes * 60 + hours * 60 * 60
-
-
 def get_subtitles(episode, cpath):
     """Return DataFrame of the subtitles.
     """
+    with timed("subtitles", bytes_read=file_size(cpath)) as counts:
+        cues = read_subtitles(cpath)
+        counts['items'] = len(cues['text'])
 
-    with open(cpath, 'r') as fin:
-        srt_lines = fin.readlines()
-
-    srt_parse = []
-    nline = []
-    for line in srt_lines:
-        if line == "\n":
-            start = _time_to_seconds(nline[1][:-1])
-            end = _time_to_seconds(nline[1][17:])
-            text = " ".join(nline[2:]).replace("\n", "")
-            text = re.sub("<[^>]+>", " ", text).strip()
-            text = re.sub("[ ]+", " ", text)
-            srt_parse.append({'start': start,
-                              'end': end,
-                              'text': text})
-            nline = []
-        else:
-            nline.append(line)
-
-    dframe = pd.DataFrame(srt_parse)
-    dframe['video'] = episode + ".mp4"
-    dframe = dframe[['video', 'start', 'end', 'text']]
+    dframe = pd.DataFrame({'video': episode + ".mp4", 'start': cues['start'],
+                           'end': cues['end'], 'text': cues['text']},
+                          columns=['video', 'start', 'end', 'text'])
 
     return dframe
 
 
-def get_args():
-    """Return the argument parser for this script.
+def get_args(argv=None):
+    """Return the arguments of this script.
+
+    Args:
+        argv: list of command line arguments; defaults to sys.argv.
     """
     desc = 'Convert jsonl files into semantic csv files.'
     parser = default_option_parser(desc)
     parser.add_argument('--verbose', dest='verbose', action='store_true')
     parser.add_argument('--breaks', dest='ch_breaks', action='store_true')
     parser.add_argument('--titles', dest='sub_titles', action='store_true')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='process the json files in bounded chunks to '
+                             'keep memory usage constant')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        default=CHUNK_SIZE,
+                        help='number of frames per chunk in streaming mode')
+    parser.add_argument('--format', dest='format', default="csv",
+                        choices=sorted(FORMATS),
+                        help='file format of the output tables')
+    parser.add_argument('--store', dest='store', action='store_true',
+                        help='read the binary dvt store instead of the '
+                             'jsonl file when it is available')
+    parser.add_argument('--shots-only', dest='shots_only',
+                        action='store_true',
+                        help='only (re)compute the frame and shots tables')
+    parser.add_argument('--dval-cut', dest='dval_cut', type=float,
+                        default=DVAL_CUT,
+                        help='minimum median frame diff at a shot boundary')
+    parser.add_argument('--hval-cut', dest='hval_cut', type=float,
+                        default=HVAL_CUT,
+                        help='minimum histogram distance at a shot boundary')
+    parser.add_argument('--min-gap', dest='min_gap', type=int,
+                        default=MIN_GAP,
+                        help='minimum number of frames between boundaries')
+    parser.add_argument('--dataset', dest='dataset', action='store_true',
+                        help='write parquet tables into one partitioned '
+                             'dataset per series in the dv-data directory')
+    parser.add_argument('--match', dest='match', default="knn",
+                        choices=METHODS,
+                        help='match faces to the nearest exemplars or to '
+                             'the centroid of each character')
+    parser.add_argument('--neighbors', dest='neighbors', type=int, default=1,
+                        help='number of exemplars voting in knn matching')
+    parser.add_argument('--unknown-cut', dest='unknown_cut', type=float,
+                        default=None,
+                        help='minimum similarity of a face to be labelled '
+                             'with a character rather than unknown')
+    parser.add_argument('--ann', dest='ann', action='store_true',
+                        help='use an approximate nearest neighbour search '
+                             '(requires hnswlib)')
+    parser.add_argument('--aggregate', dest='aggregate', action='store_true',
+                        help='update the series level presence, screen '
+                             'time and shot length tables')
+
+    args = parser.parse_args(argv)
+    if args.dataset and args.format != "parquet":
+        parser.error("--dataset requires --format parquet")
+    if args.aggregate and args.shots_only:
+        parser.error("--aggregate cannot be used with --shots-only")
+
+    return args
+
+
+def get_index_options(args):
+    """Return the FaceIndex matching options selected by the user.
+    """
+    return {'method': args.match, 'neighbors': args.neighbors,
+            'threshold': args.unknown_cut, 'ann': args.ann}
 
-    return parser.parse_args()
+
+def process_episode(episode, args):
+    """Convert the jsonl file of a single episode into table files.
+
+    The episode is skipped when the manifest shows that its output files
+    are up to date, unless the --force flag is given. The face index of
+    the series is loaded once by each worker.
+    """
+    paths = get_io_paths(episode)
+    json_file = join(paths['spath'], episode + "-dvt.jsonl")
+    dvt_path = json_file
+    dvt_input = json_file
+    if args.store and os.path.isdir(get_store_path(json_file)):
+        dvt_path = get_store_path(json_file)
+        dvt_input = join(dvt_path, "meta.json")
+
+    if args.shots_only:
+        stage = "shots"
+        tables = ["frame", "shots"]
+        inputs = [dvt_input]
+    else:
+        stage = "csv"
+        tables = ["video", "frame", "shots", "faces", "yolos"]
+        inputs = [dvt_input, get_index_input(args.series)]
+    if args.ch_breaks and not args.shots_only:
+        tables.append("chaps")
+        inputs.append(paths['ifile'])
+    if args.sub_titles and not args.shots_only:
+        tables.append("title")
+        inputs.append(paths['ifile_srt'])
+    opaths = {x: get_table_path(episode, x, args.format, args.dataset)
+              for x in tables}
+    if args.aggregate:
+        opaths.update({x: get_aggregate_path(args.series, x, args.format)
+                       for x in AGGREGATES})
+
+    manifest = get_manifest(args.series)
+    shot_params = {'dval_cut': args.dval_cut, 'hval_cut': args.hval_cut,
+                   'min_gap': args.min_gap}
+    params = dict(format=args.format, dataset=args.dataset,
+                  aggregate=args.aggregate, **shot_params)
+    if not args.shots_only:
+        params.update(get_index_options(args))
+    if not args.force and manifest.is_current(
+            stage, episode, inputs, list(opaths.values()), STAGE_VERSION,
+            params):
+        if args.verbose:
+            print("Skipping {0:s}; up to date".format(episode))
+        return
+
+    # only re-segment the shots, using whole-episode arrays
+    if args.shots_only:
+        frame, shots = get_shots(dvt_path, **shot_params)
+        write_table(frame, opaths["frame"], args.format)
+        write_table(shots, opaths["shots"], args.format)
+        manifest.record(stage, episode, inputs, list(opaths.values()),
+                        STAGE_VERSION, params)
+        return
+
+    # process the json file; extract frames, shots, faces, and objects
+    findex = load_face_index(args.series, **get_index_options(args))
+    jprc = JsonProcessor(path=dvt_path, fprint=findex, stream=args.stream,
+                         **shot_params)
+
+    # save dvt extracted data in table files
+    aggregator = EpisodeAggregator() if args.aggregate else None
+    if args.stream:
+        write_chunks(jprc, [opaths[x] for x in tables[1:5]],
+                     fmt=args.format, chunk_size=args.chunk_size,
+                     aggregator=aggregator)
+        video = jprc.get_video()
+    else:
+        video, frame, shots, faces, yolos = jprc.get_data()
+        write_table(frame, opaths["frame"], args.format)
+        write_table(shots, opaths["shots"], args.format)
+        write_table(faces, opaths["faces"], args.format)
+        write_table(yolos, opaths["yolos"], args.format)
+        if aggregator is not None:
+            aggregator.add(frame, faces)
+    write_table(video, opaths["video"], args.format)
+
+    # replace the rows of this episode in the series level tables
+    if aggregator is not None:
+        with timed("aggregate"):
+            update_aggregates(args.series, aggregator.get_tables(
+                jprc.video, video['fps'][0], jprc.get_sampling()),
+                              args.format)
+
+    # get chapter breaks from the mp4 file
+    if args.ch_breaks:
+        chaps = get_chapter_breaks(paths['ifile'])
+        write_table(chaps, opaths["chaps"], args.format)
+
+    # get subtitles as DataFrame and save as a table
+    if args.sub_titles:
+        title = get_subtitles(episode, paths['ifile_srt'])
+        write_table(title, opaths["title"], args.format)
+
+    manifest.record(stage, episode, inputs, list(opaths.values()),
+                    STAGE_VERSION, params)
 
 
 def process_csv_files():
     """Convert all of the selected jsonl files into csv files
     """
     args = get_args()
-    fdir = join(read_user_properties()['basepath'], "model", "fprint")
 
-    with open(join(fdir, args.series + "fingerprint.pickle"), "rb") as fin:
-        fprint = pickle.load(fin)
+    episodes = get_episodes(args)
 
-    for episode in get_episodes(args):
-        paths = get_io_paths(episode)
+    # probe all of the videos at once; the workers then read the cache
+    if args.ch_breaks and not args.shots_only:
+        probe_many(episodes, jobs=max(args.jobs, 4))
 
-        # process the json file; extract frames, shots, faces, and objects
-        jprc = JsonProcessor(path=join(paths['spath'], episode + "-dvt.jsonl"),
-                             fprint=fprint)
-        video, frame, shots, faces, yolos = jprc.get_data()
-
-        # save dvt extracted data in csv files
-        video.to_csv(join(paths['spath'], episode + "-video.csv"), index=False)
-        frame.to_csv(join(paths['spath'], episode + "-frame.csv"), index=False)
-        shots.to_csv(join(paths['spath'], episode + "-shots.csv"), index=False)
-        faces.to_csv(join(paths['spath'], episode + "-faces.csv"), index=False)
-        yolos.to_csv(join(paths['spath'], episode + "-yolos.csv"),
-                     index=False)
-
-        # get chapter breaks from the mp4 file
-        if args.ch_breaks:
-            chaps = get_chapter_breaks(paths['ifile'])
-            chaps.to_csv(join(paths['spath'], episode + "-chaps.csv"),
-                         index=False)
-
-        # get subtitles as DataFrame and save as csv file
-        if args.ch_breaks:
-            title = get_subtitles(episode, paths['ifile_srt'])
-            title.to_csv(join(paths['spath'], episode + "-title.csv"),
-                         index=False)
-
-        # echo progress
-        if args.verbose:
-            print("Finished with {0:s}".format(episode))
+    failed = run_episodes(functools.partial(process_episode, args=args),
+                          episodes, jobs=args.jobs, verbose=args.verbose,
+                          metrics=args.metrics, profile=args.profile)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,104 +1,320 @@
 # -*- coding: utf-8 -*-
-"""Run distant viewing toolkit over video files
+"""Export still frames from video files
 
-This callable module is used to run the distant viewing toolkit over
-a set of raw mp4 files. You can select the series and (optionally)
-the season and episodes using command line arguments. Other arguments
-determine the specific annotators that will be run.
+This callable module is used to export still frames of a set of raw mp4
+files after the distant viewing toolkit has been run over them. Frames
+are decoded and scaled by ffmpeg and encoded as png, jpeg, or webp images
+by a pool of background threads, so annotation never waits on image
+output. The dvt output of each episode is used to choose the frames:
+every frame, every n-th frame, or one keyframe from the middle of each
+shot, skipping frames whose histogram is nearly identical to that of the
+previously exported frame.
+
+The images are written to the frame directory of each episode, along
+with a file frames.csv listing the frame number, shot and file name of
+every exported image.
 
 Example:
-    To process the first 4 episodes from season 2 of Bewitched,
-    we would run the following:
+    To export one 480 pixel wide jpeg for each shot of the first 4
+    episodes from season 2 of Bewitched, we would run the following:
 
-        $ python3 script03_run_dvt.py --series bw --season 2 --episode 1 2 3 4 
+        $ python3 script06_png.py --series bw --season 2 --episode 1 2 3 4 \
+                                  --select shots --image-format jpeg \
+                                  --width 480
 
 """
-
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import functools
 import os
 from os.path import join
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from dvtstore import get_store_path
+from manifest import get_manifest
+from probe import probe
+from script05_process_json import load_shot_signals, segment_shots
+from utils import default_option_parser, file_size, get_episodes, \
+                  get_io_paths, run_episodes, timed
+
+STAGE_VERSION = 1
+IMAGE_FORMATS = {'png': ".png", 'jpeg': ".jpg", 'webp': ".webp"}
+
+
+def select_frames(frames, hist, sid, select="all", stride=1, dedup_cut=0):
+    """Choose the frames to export.
+
+    Args:
+        frames: array of frame numbers.
+        hist: matrix of HSV histograms, one row per frame.
+        sid: array giving the shot id of each frame.
+        select: "all" for every frame or "shots" for the middle frame of
+            each shot.
+        stride: with "all", only take every 'stride'-th frame.
+        dedup_cut: skip a frame when the mean absolute difference between
+            its histogram and that of the last exported frame is at most
+            this value; zero keeps every chosen frame.
+    Returns:
+        array of the row indices of the exported frames.
+    """
+    if select == "shots":
+        starts = np.flatnonzero(np.diff(sid, prepend=-1))
+        stops = np.append(starts[1:], len(sid))
+        rows = (starts + stops) // 2
+    else:
+        rows = np.arange(0, len(frames), max(stride, 1))
 
-from utils import default_option_parser, get_episodes, get_io_paths
-
+    if dedup_cut <= 0 or not len(rows):
+        return rows
 
-def setup_tensorflow():
-    """Help
-    """
-    import tensorflow as tf
-    from keras.backend.tensorflow_backend import set_session
+    hist = np.asarray(hist, dtype=np.float64)
+    keep = [rows[0]]
+    for row in rows[1:]:
+        if np.mean(np.abs(hist[row] - hist[keep[-1]])) > dedup_cut:
+            keep.append(row)
 
-    config = tf.ConfigProto()
-    config.gpu_options.per_process_gpu_memory_fraction = 0.5
-    set_session(tf.Session(config=config))
+    return np.array(keep, dtype=np.int64)
 
 
-def get_processor(args):
-    """Help
+def get_scaled_size(width, height, new_width):
+    """Return the even frame size after scaling to a given width.
     """
-    import dvt
+    if not new_width or new_width >= width:
+        return width, height
 
-    vproc = dvt.video.VideoProcessor()
-    vproc.load_annotator(dvt.frame.DiffFrameAnnotator())
-    vproc.load_annotator(dvt.frame.HistogramFrameAnnotator())
-    vproc.load_annotator(dvt.frame.TerminateFrameAnnotator())
-    #vproc.load_annotator(dvt.frame.ObjectCocoFrameAnnotator())
-    vproc.load_annotator(dvt.frame.FaceFrameAnnotator())
-    if args.png_flag:
-        vproc.load_annotator(dvt.frame.PngFrameAnnotator(output_dir="/"))
-    return vproc
+    return new_width - new_width % 2, \
+        max(int(round(height * new_width / width / 2)) * 2, 2)
 
 
-def process_video(vproc, video_file, json_file, frame_path, args):
-    """Help
+def get_select_filter(numbers, stride=1):
+    """Return the ffmpeg select filter passing the given frame numbers.
+
+    Args:
+        numbers: sorted list of frame numbers, or None to pass every
+            'stride'-th frame.
+        stride: interval between frames when 'numbers' is None.
+    Returns:
+        string giving the filter, or None when every frame is passed.
+    """
+    if numbers is None:
+        if stride <= 1:
+            return None
+        return "select='not(mod(n\\,{0:d}))'".format(stride)
+
+    # runs of consecutive frames are passed as a single range
+    terms = []
+    for num in numbers:
+        if terms and terms[-1][1] == num - 1:
+            terms[-1][1] = num
+        else:
+            terms.append([num, num])
+
+    return "select='" + "+".join(
+        "eq(n\\,{0:d})".format(a) if a == b else
+        "between(n\\,{0:d}\\,{1:d})".format(a, b) for a, b in terms) + "'"
+
+
+def decode_frames(video_file, select, size):
+    """Decode frames from a video as RGB arrays.
+
+    Frames are selected and scaled inside ffmpeg, so only the exported
+    frames are passed back as raw RGB data.
+
+    Args:
+        video_file: string describing the path to the video file.
+        select: ffmpeg select filter, as from get_select_filter.
+        size: tuple of the output width and height.
+    Returns:
+        a generator of RGB arrays with shape (height, width, 3).
+    """
+    filters = [] if select is None else [select]
+    filters.append("scale={0:d}:{1:d}".format(*size))
+
+    # the filter is passed in a file since it may list many frames
+    fdesc, filter_file = tempfile.mkstemp(suffix=".filter")
+    with os.fdopen(fdesc, "w") as fout:
+        fout.write(",".join(filters))
+
+    frame_bytes = size[0] * size[1] * 3
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen(["ffmpeg", "-i", video_file, "-an",
+                                 "-filter_script:v", filter_file,
+                                 "-vsync", "0", "-f", "rawvideo",
+                                 "-pix_fmt", "rgb24", "-"],
+                                stdout=subprocess.PIPE, stderr=devnull)
+    try:
+        while True:
+            data = proc.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                break
+            yield np.frombuffer(data, dtype=np.uint8).reshape(
+                (size[1], size[0], 3))
+    finally:
+        # stop ffmpeg if the caller does not read every frame
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        os.remove(filter_file)
+
+
+def save_image(img, path, fmt, quality):
+    """Encode an RGB array as an image file.
     """
+    from PIL import Image
 
-    # make sure staging area has been created
-    os.makedirs(os.path.dirname(json_file), exist_ok=True)
+    options = {}
+    if fmt in ["jpeg", "webp"]:
+        options['quality'] = quality
+    if fmt == "png":
+        options['compress_level'] = 1
 
-    # if creating frames, make sure output directory exists
-    if args.png_flag:
-        os.makedirs(frame_path, exist_ok=True)
-        vproc.pipeline['png'].output_dir = frame_path
+    tmp_path = path + ".tmp"
+    Image.fromarray(img).save(tmp_path, format=fmt.upper(), **options)
+    os.replace(tmp_path, path)
 
-    # clear the pipeline and setup metadata
-    vproc.pipeline['diff'].clear()
-    vproc.setup_input(video_path=video_file, output_path=json_file)
 
-    # run the pipeline
-    vproc.process(verbose=args.verbose)
+def export_frames(video_file, frame_path, frames, sid, rows, size, args):
+    """Decode the selected frames and write them with a pool of threads.
+
+    At most twice as many frames as there are threads are held in memory
+    while waiting to be written.
+
+    Returns:
+        list of (frame, sid, file name) tuples of the exported frames.
+    """
+    os.makedirs(frame_path, exist_ok=True)
+    ext = IMAGE_FORMATS[args.image_format]
+
+    # strides are selected arithmetically rather than by listing every
+    # frame; frames dropped as duplicates are skipped after decoding
+    if args.select == "all":
+        select = get_select_filter(None, args.stride)
+        decoded = range(0, len(frames), max(args.stride, 1))
+    else:
+        select = get_select_filter([int(frames[x]) for x in rows])
+        decoded = rows
+    keep = set(int(x) for x in rows)
+
+    exported = []
+    pending = []
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for img, row in zip(decode_frames(video_file, select, size),
+                            decoded):
+            if row not in keep:
+                continue
+            fname = "frame-{0:06d}{1:s}".format(int(frames[row]), ext)
+            pending.append(executor.submit(save_image, img,
+                                           join(frame_path, fname),
+                                           args.image_format, args.quality))
+            exported.append((int(frames[row]), int(sid[row]), fname))
+            if len(pending) >= 2 * args.threads:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+
+    return exported
 
 
 def get_args():
-    """Help
+    """Return the argument parser for this script.
     """
-    desc = 'Run distant viewing toolkit on raw mp4 files.'
+    desc = 'Export still frames from raw mp4 files.'
     parser = default_option_parser(desc)
-    parser.add_argument('--frames', dest='png_flag', action='store_true')
     parser.add_argument('--verbose', dest='verbose', action='store_true')
+    parser.add_argument('--select', dest='select', default="all",
+                        choices=["all", "shots"],
+                        help='export every frame or one frame per shot')
+    parser.add_argument('--stride', dest='stride', type=int, default=1,
+                        help='with --select all, export every n-th frame')
+    parser.add_argument('--dedup-cut', dest='dedup_cut', type=float,
+                        default=0,
+                        help='skip frames whose histogram distance to the '
+                             'last exported frame is at most this value')
+    parser.add_argument('--image-format', dest='image_format', default="png",
+                        choices=sorted(IMAGE_FORMATS),
+                        help='file format of the images')
+    parser.add_argument('--quality', dest='quality', type=int, default=85,
+                        help='jpeg and webp quality, from 1 to 100')
+    parser.add_argument('--width', dest='width', type=int, default=0,
+                        help='scale frames down to this width')
+    parser.add_argument('--threads', dest='threads', type=int, default=4,
+                        help='number of threads encoding images')
 
     return parser.parse_args()
 
 
-def run_pipeline():
-    """Help
+def run_episode(episode, args):
+    """Export the selected frames of a single episode.
+
+    The episode is skipped when the manifest shows that its frames are up
+    to date, unless the --force flag is given.
+    """
+    paths = get_io_paths(episode)
+
+    video_file = paths['ifile']
+    json_file = join(paths['spath'], episode + "-dvt.jsonl")
+    dvt_path = json_file
+    if os.path.isfile(join(get_store_path(json_file), "meta.json")):
+        dvt_path = get_store_path(json_file)
+    list_file = join(paths['fpath'], "frames.csv")
+
+    manifest = get_manifest(episode.split("-")[0])
+    params = {'select': args.select, 'stride': args.stride,
+              'dedup_cut': args.dedup_cut, 'format': args.image_format,
+              'quality': args.quality, 'width': args.width}
+    if not args.force and manifest.is_current(
+            "frames", episode, [video_file, json_file], [list_file],
+            STAGE_VERSION, params):
+        if args.verbose:
+            print("Skipping {0:s}; up to date".format(episode))
+        return
+
+    with timed("select", bytes_read=file_size(dvt_path)) as counts:
+        _, frames, hist, dval = load_shot_signals(dvt_path)
+        _, sid, _ = segment_shots(frames, hist, dval)
+        rows = select_frames(frames, hist, sid, args.select, args.stride,
+                             args.dedup_cut)
+        counts['items'] = len(rows)
+
+    info = probe(episode)
+    size = get_scaled_size(info['width'], info['height'], args.width)
+    with timed("export", bytes_read=file_size(video_file),
+               items=len(rows)):
+        exported = export_frames(video_file, paths['fpath'], frames, sid,
+                                 rows, size, args)
+
+    with open(list_file, "w", newline="") as fout:
+        writer = csv.writer(fout)
+        writer.writerow(["frame", "sid", "file"])
+        writer.writerows(exported)
+
+    if args.verbose:
+        print("Exported {0:d} of {1:d} frames of {2:s}".format(
+            len(exported), len(frames), episode))
+
+    manifest.record("frames", episode, [video_file, json_file], [list_file],
+                    STAGE_VERSION, params)
+
+
+def run_export():
+    """Run the module with the selected user arguments.
     """
     args = get_args()
 
-    from keras import backend as K
-
-    for episode in get_episodes(args):
-        vproc = get_processor(args)
-
-        paths = get_io_paths(episode)
-
-        video_file = paths['ifile']
-        json_file = join(paths['spath'], episode + "-dvt.jsonl")
-        frame_path = paths['fpath']
-
-        process_video(vproc, video_file, json_file, frame_path, args)
-
-        K.clear_session()   # garbage collect for GPU memory
+    # ffmpeg and the image encoders release the GIL, so threads are enough
+    # to export several episodes at once
+    failed = run_episodes(functools.partial(run_episode, args=args),
+                          get_episodes(args), jobs=args.jobs,
+                          verbose=args.verbose, threads=True,
+                          metrics=args.metrics, profile=args.profile)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
-    run_pipeline()
-
+    run_export()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""Parse SRT and WebVTT subtitle files.
+
+Cues are streamed from the file one at a time and parsed with plain
+string operations. The parser accepts either format, any line ending, a
+byte order mark, files without a trailing blank line, timestamps with or
+without hours, and text in UTF-8 or a legacy single-byte encoding.
+"""
+import numpy as np
+
+ENCODINGS = ['utf-8-sig', 'cp1252', 'latin-1']
+
+
+def detect_encoding(path):
+    """Return the first of ENCODINGS that can decode a file.
+    """
+    with open(path, "rb") as fin:
+        data = fin.read()
+
+    for encoding in ENCODINGS[:-1]:
+        try:
+            data.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            pass
+
+    return ENCODINGS[-1]
+
+
+def parse_timestamp(stamp):
+    """Convert a timestamp such as "01:02:03,456" into seconds.
+
+    Both the SRT (comma) and WebVTT (period) millisecond separators are
+    accepted, and the hours may be omitted.
+    """
+    parts = stamp.strip().replace(",", ".").split(":")
+    seconds = float(parts[-1])
+    if len(parts) > 1:
+        seconds += 60 * int(parts[-2])
+    if len(parts) > 2:
+        seconds += 3600 * int(parts[-3])
+
+    return seconds
+
+
+def strip_tags(text):
+    """Replace markup such as <i> or {\\an8} with spaces and tidy spacing.
+    """
+    for left, right in [("<", ">"), ("{\\", "}")]:
+        start = text.find(left)
+        while start >= 0:
+            stop = text.find(right, start)
+            if stop < 0:
+                break
+            text = text[:start] + " " + text[stop + 1:]
+            start = text.find(left, start)
+
+    return " ".join(text.split())
+
+
+def _make_cue(timing, text):
+    start, _, end = timing.partition("-->")
+    # WebVTT cue settings may follow the end time
+    end = end.split()[0] if end.split() else end
+
+    return parse_timestamp(start), parse_timestamp(end), \
+        strip_tags(" ".join(text))
+
+
+def iter_cues(path, encoding=None):
+    """Iterate over the cues of a subtitle file.
+
+    Args:
+        path: string describing the path to an srt or vtt file.
+        encoding: text encoding; detected from the file when None.
+    Returns:
+        a generator of (start, end, text) tuples, with times in seconds.
+    """
+    if encoding is None:
+        encoding = detect_encoding(path)
+
+    timing = None
+    text = []
+    with open(path, "r", encoding=encoding, newline=None) as fin:
+        for line in fin:
+            line = line.strip()
+            if not line:
+                if timing is not None:
+                    yield _make_cue(timing, text)
+                timing = None
+                text = []
+            elif timing is None:
+                # cue numbers, cue identifiers and header blocks (WEBVTT,
+                # NOTE, STYLE) appear before any timing line and are skipped
+                if "-->" in line:
+                    timing = line
+            else:
+                text.append(line)
+
+    if timing is not None:
+        yield _make_cue(timing, text)
+
+
+def read_subtitles(path, encoding=None):
+    """Read all cues of a subtitle file into column arrays.
+
+    Args:
+        path: string describing the path to an srt or vtt file.
+        encoding: text encoding; detected from the file when None.
+    Returns:
+        a dictionary with float arrays 'start' and 'end' and a list
+        'text', with one element per cue.
+    """
+    start = []
+    end = []
+    text = []
+    for cue in iter_cues(path, encoding):
+        start.append(cue[0])
+        end.append(cue[1])
+        text.append(cue[2])
+
+    return {'start': np.array(start, dtype=np.float64),
+            'end': np.array(end, dtype=np.float64),
+            'text': text}
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Write tabular pipeline output as csv, parquet, or feather files.
+
+Binary formats store the string columns that repeat on every row (the
+video name, character and object class) as categorical columns and are
+compressed with zstd. Parquet output may also be arranged as a single
+hive-partitioned dataset per series, with one directory per table and
+season, which can be read back in one call with pandas.read_parquet.
+"""
+import os
+from os.path import join
+
+import pandas as pd
+
+from utils import file_size, get_io_paths, timed
+
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+CATEGORICAL = ['video', 'character', 'class']
+COMPRESSION = 'zstd'
+
+
+def get_table_path(episode, table, fmt="csv", dataset=False):
+    """Return the output path of a table for an episode.
+
+    Args:
+        episode: string describing the episode.
+        table: name of the table, such as "frame" or "faces".
+        fmt: output format; one of the keys of FORMATS.
+        dataset: Boolean value. Should the path point into the series
+            level partitioned dataset rather than the staging area.
+    Returns:
+        string giving the path of the output file.
+    """
+    paths = get_io_paths(episode)
+    if dataset:
+        season = "season=" + episode.split("-")[1]
+        return join(paths['opath'], table, season, episode + FORMATS[fmt])
+
+    return join(paths['spath'], episode + "-" + table + FORMATS[fmt])
+
+
+def _categorize(dframe):
+    dframe = dframe.copy()
+    for col in CATEGORICAL:
+        if col in dframe.columns:
+            dframe[col] = dframe[col].astype('category')
+
+    return dframe
+
+
+class TableWriter():
+    """Write a DataFrame to disk, possibly in several chunks.
+
+    All chunks must share the same columns. Csv and parquet chunks are
+    written as they arrive; the feather format cannot be appended to, so
+    feather chunks are combined and written when the writer is closed.
+    """
+    def __init__(self, path, fmt="csv"):
+        if fmt not in FORMATS:
+            raise ValueError('Unknown output format "' + fmt + '"')
+
+        self.path = path
+        self.fmt = fmt
+        self.nchunks = 0
+        self._chunks = []
+        self._writer = None
+        self._schema = None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == "csv":
+            self._writer = open(path, 'w', newline='')
+
+    def write(self, dframe):
+        """Write a chunk of rows to the output.
+        """
+        with timed("write", items=len(dframe)):
+            self._write(dframe)
+        self.nchunks += 1
+
+    def _write(self, dframe):
+        if self.fmt == "csv":
+            dframe.to_csv(self._writer, header=(self.nchunks == 0),
+                          index=False)
+        elif self.fmt == "feather":
+            self._chunks.append(dframe)
+        elif self._writer is None:
+            # the parquet schema is taken from the first non-empty chunk,
+            # since empty object columns carry no type information
+            self._chunks = [dframe]
+            if len(dframe):
+                self._write_parquet(dframe)
+                self._chunks = []
+        else:
+            self._write_parquet(dframe)
+
+    def _write_parquet(self, dframe):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        dframe = _categorize(dframe)
+        if self._writer is None:
+            table = pa.Table.from_pandas(dframe, preserve_index=False)
+            self._schema = table.schema
+            self._writer = pq.ParquetWriter(self.path, self._schema,
+                                            compression=COMPRESSION)
+        else:
+            table = pa.Table.from_pandas(dframe, schema=self._schema,
+                                         preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        """Flush any buffered rows and close the output file.
+        """
+        with timed("write") as counts:
+            self._close()
+            counts['bytes_written'] = file_size(self.path)
+
+    def _close(self):
+        if self.fmt == "feather" and self._chunks:
+            dframe = pd.concat(self._chunks, ignore_index=True)
+            _categorize(dframe).to_feather(self.path, compression=COMPRESSION)
+        elif self.fmt == "parquet" and self._chunks:
+            dframe = pd.concat(self._chunks, ignore_index=True)
+            _categorize(dframe).to_parquet(self.path, index=False,
+                                           compression=COMPRESSION)
+
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = None
+        self._chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_table(dframe, path, fmt="csv"):
+    """Write a DataFrame to disk in a single chunk.
+    """
+    with TableWriter(path, fmt) as writer:
+        writer.write(dframe)
+
+
+def read_table(path, fmt="csv"):
+    """Read a table written by write_table or TableWriter.
+    """
+    with timed("read", bytes_read=file_size(path)):
+        if fmt == "csv":
+            return pd.read_csv(path)
+        if fmt == "parquet":
+            return pd.read_parquet(path)
+        if fmt == "feather":
+            return pd.read_feather(path)
+
+    raise ValueError('Unknown output format "' + fmt + '"')
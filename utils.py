@@ -3,17 +3,41 @@
 
 General purpose functions for the other modules in this directory.
 Modify the file "params.json" to adjust the user-level parameters
-that may differ between systems.
+that may differ between systems. Another parameter file can be selected
+with the DV_PARAMS environment variable or the --params option.
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import cProfile
 import datetime
+import fcntl
 import json
 import os
 from os.path import join
+import re
+import resource
+import sys
+import threading
+import time
+import traceback
 
 import numpy as np
 
+PARAMS_ENV = "DV_PARAMS"
+
+# seconds within which a directory listing may miss a change that does not
+# alter the directory modification time, e.g., on NFS or SMB mounts
+MTIME_SLACK = 2
+
+# metrics of the episode being processed by the current thread
+_METRICS = threading.local()
+
+# parameter files and episode catalogs loaded by this process
+_PARAMS = {}
+_CATALOGS = {}
+
 
 def iso8601():
     """Return current time as an string formated according to ISO8601.
@@ -35,6 +59,21 @@ def norm_array(np_array):
     return np_array
 
 
+def norm_rows(np_array):
+    """Normalize each row of a two-dimensional numpy array.
+
+    Args:
+        np_array: A numpy array or coercible list of lists.
+    Returns:
+        A new float array with every row normalized by its l2 norm.
+    """
+    np_array = np.array(np_array, dtype=np.float64, ndmin=2)
+    norms = np.sqrt(np.sum(np_array**2, axis=1, keepdims=True))
+    np_array = np_array / np.where(norms > 0, norms, 1)
+
+    return np_array
+
+
 def load_jsonl(jpath):
     """Load json line path as list of dictionaries.
 
@@ -50,10 +89,237 @@ def load_jsonl(jpath):
     return data
 
 
+def iter_jsonl(jpath):
+    """Lazily iterate over the lines of a json line file.
+
+    Args:
+        jpath: string describing the path to the json file.
+    Returns:
+        a generator yielding one dictionary for each line in the file.
+    """
+    with open(jpath) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _rfind_newline(fobj, end, block_size=2**16):
+    # return the position of the last newline before 'end', or -1
+    while end > 0:
+        start = max(end - block_size, 0)
+        fobj.seek(start)
+        pos = fobj.read(end - start).rfind(b"\n")
+        if pos >= 0:
+            return start + pos
+        end = start
+
+    return -1
+
+
+def truncate_jsonl(jpath):
+    """Remove an incomplete last line from a json line file.
+
+    A line is complete when it ends with a newline and parses as json, so
+    a file left behind by an interrupted writer can be appended to.
+
+    Args:
+        jpath: string describing the path to the json file.
+    Returns:
+        the dictionary of the last complete line, or None if there is none.
+    """
+    with open(jpath, "rb+") as fobj:
+        end = fobj.seek(0, os.SEEK_END)
+        while True:
+            stop = _rfind_newline(fobj, end)
+            fobj.truncate(stop + 1)
+            if stop < 0:
+                return None
+
+            start = _rfind_newline(fobj, stop) + 1
+            fobj.seek(start)
+            try:
+                return json.loads(fobj.read(stop - start))
+            except ValueError:
+                end = start
+
+
+def get_jsonl_index_path(jpath):
+    """Return the path of the sidecar offset index of a json line file.
+    """
+    return os.path.splitext(jpath)[0] + ".idx.npz"
+
+
+def build_jsonl_index(jpath):
+    """Build and save the sidecar offset index of a json line file.
+
+    The index records the byte offset at which each line starts (plus the
+    total file size) and, for frame lines, the frame number. Frame numbers
+    are read with a regular expression rather than by parsing the json.
+
+    Args:
+        jpath: string describing the path to the json file.
+    Returns:
+        tuple of two numpy arrays, the offsets and the frame numbers (-1
+        for lines that do not describe a frame).
+    """
+    is_frame = re.compile(rb'"type":\s*"frame"')
+    frame_num = re.compile(rb'"frame":\s*(-?[0-9]+)')
+
+    offsets = [0]
+    frames = []
+    with open(jpath, "rb") as fin:
+        for line in fin:
+            offsets.append(offsets[-1] + len(line))
+            if not is_frame.search(line):
+                frames.append(-1)
+                continue
+
+            match = frame_num.search(line)
+            if match is not None:
+                frames.append(int(match.group(1)))
+            else:
+                frames.append(json.loads(line)['frame'])
+
+    offsets = np.array(offsets, dtype=np.int64)
+    frames = np.array(frames, dtype=np.int64)
+    stat = os.stat(jpath)
+    np.savez(get_jsonl_index_path(jpath), offsets=offsets, frames=frames,
+             size=stat.st_size, mtime=stat.st_mtime)
+
+    return offsets, frames
+
+
+def load_jsonl_index(jpath):
+    """Load the sidecar offset index of a json line file.
+
+    The index is (re)built when it does not exist or when the json file
+    has changed since the index was written.
+
+    Args:
+        jpath: string describing the path to the json file.
+    Returns:
+        tuple of two numpy arrays, as returned by build_jsonl_index.
+    """
+    index_path = get_jsonl_index_path(jpath)
+    if os.path.isfile(index_path):
+        stat = os.stat(jpath)
+        with np.load(index_path) as index:
+            if index['size'] == stat.st_size and \
+                    index['mtime'] == stat.st_mtime:
+                return index['offsets'], index['frames']
+
+    return build_jsonl_index(jpath)
+
+
+class IndexedJsonl():
+    """Random access to the lines of a json line file.
+
+    Lines are located with the sidecar offset index, so reading a line or
+    a range of frames only parses those lines. Indexing the object with a
+    line number returns the same dictionary as load_jsonl(jpath)[lineno].
+    """
+    def __init__(self, jpath):
+        self.path = jpath
+        self.offsets, self.frames = load_jsonl_index(jpath)
+        self._rows = np.flatnonzero(self.frames >= 0)
+        order = np.argsort(self.frames[self._rows], kind="stable")
+        self._rows = self._rows[order]
+        self._numbers = self.frames[self._rows]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, lineno):
+        if lineno < 0:
+            lineno += len(self)
+
+        return self.lines(lineno, lineno + 1)[0]
+
+    def lines(self, start, stop):
+        """Return the parsed lines with numbers in [start, stop).
+        """
+        start = max(start, 0)
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+
+        with open(self.path, "rb") as fin:
+            fin.seek(self.offsets[start])
+            chunk = fin.read(self.offsets[stop] - self.offsets[start])
+
+        return [json.loads(line) for line in chunk.splitlines()]
+
+    def frame(self, number):
+        """Return the parsed line describing a given frame number.
+        """
+        idx = np.searchsorted(self._numbers, number)
+        if idx == len(self._numbers) or self._numbers[idx] != number:
+            raise KeyError("frame {0:d} not found".format(number))
+
+        return self[int(self._rows[idx])]
+
+    def frame_range(self, start, stop):
+        """Return the parsed lines for frame numbers in [start, stop).
+        """
+        first = np.searchsorted(self._numbers, start)
+        last = np.searchsorted(self._numbers, stop)
+        rows = np.sort(self._rows[first:last])
+        if not len(rows):
+            return []
+
+        # read one contiguous block and keep only the frame lines in range
+        lines = self.lines(int(rows[0]), int(rows[-1]) + 1)
+        keep = set((rows - rows[0]).tolist())
+        return [x for num, x in enumerate(lines) if num in keep]
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on the sidecar ".lock" file of a path.
+
+    The directory of the path is created if needed.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "w") as flock:
+        fcntl.flock(flock, fcntl.LOCK_EX)
+        yield
+
+
+def update_json(path, update):
+    """Update a json file in place while holding an exclusive lock.
+
+    Several processes may update the same file: each one takes a lock on
+    a sidecar ".lock" file, reads the current contents, applies 'update'
+    and atomically replaces the file.
+
+    Args:
+        path: string describing the path to the json file.
+        update: function that modifies the dictionary read from the file
+            (an empty dictionary if the file does not yet exist).
+    Returns:
+        None
+    """
+    with file_lock(path):
+        data = {}
+        if os.path.isfile(path):
+            with open(path, "r") as fin:
+                data = json.load(fin)
+        update(data)
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fout:
+            json.dump(data, fout, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+
 def default_option_parser(desc):
     """Return a default option parser
     """
     parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('--params', action=_ParamsAction, dest="params",
+                        default=None,
+                        help='path to the parameter file; defaults to the '
+                             'DV_PARAMS environment variable or '
+                             'params.json in the working directory')
     parser.add_argument('--series', action="store", dest="series",
                         help='name of the series to process data from',
                         required=True)
@@ -67,19 +333,163 @@ def default_option_parser(desc):
                         help='episode to parse; select multiple episodes '
                              'separated by spaces; leave blank to select '
                              'all episodes')
+    parser.add_argument('--jobs', action="store", dest="jobs", type=int,
+                        default=1,
+                        help='number of episodes to process in parallel '
+                             'worker processes')
+    parser.add_argument('--force', action="store_true", dest="force",
+                        help='recompute outputs even when the manifest '
+                             'shows that they are up to date')
+    parser.add_argument('--metrics', action="store", dest="metrics",
+                        default=None,
+                        help='path of a jsonl file to which per-episode '
+                             'timing metrics are appended')
+    parser.add_argument('--profile', action="store", dest="profile",
+                        default=None,
+                        help='directory in which to save a cProfile dump '
+                             'for each episode')
     return parser
 
 
+class _ParamsAction(argparse.Action):
+    """Point the parameter file at the path given on the command line.
+
+    The path is exported through the environment so that worker processes
+    and subprocesses read the same file.
+    """
+    def __call__(self, parser, namespace, values, option_string=None):
+        os.environ[PARAMS_ENV] = os.path.abspath(values)
+        setattr(namespace, self.dest, values)
+
+
+def get_params_path():
+    """Return the path of the user parameter file.
+
+    This is the value of the DV_PARAMS environment variable when it is set
+    (e.g., by the --params option) and "params.json" in the working
+    directory otherwise.
+    """
+    return os.path.abspath(os.environ.get(PARAMS_ENV, "params.json"))
+
+
 def read_user_properties() -> dict:
     """Read properties json file file user properties.
 
+    The file is only read once per process; later calls return the cached
+    dictionary, which must not be modified.
+
     Returns:
         dict: Dictionary of the parameter file.
     """
-    with open("params.json", "r") as param_file:
-        params = json.load(param_file)
+    path = get_params_path()
+    if path not in _PARAMS:
+        with open(path, "r") as param_file:
+            _PARAMS[path] = json.load(param_file)
+
+    return _PARAMS[path]
+
+
+class EpisodeCatalog():
+    """List of the episodes of a series, indexed by season and episode.
+
+    The listing of the input directory is cached in memory and in a json
+    file in the staging directory, together with the modification time of
+    the input directory. The directory is only scanned again when that
+    time changes, i.e., when files are added, removed or renamed. Since
+    file systems with a coarse time resolution may not change the time
+    for a file added just after a scan, a listing taken within
+    MTIME_SLACK seconds of the modification time is neither cached nor
+    trusted, and the directory is scanned again on the next refresh.
+    """
+    def __init__(self, series):
+        basepath = read_user_properties()['basepath']
+        self.series = series
+        self.input_dir = join(basepath, "input", series)
+        self.cache_path = join(basepath, "stage", series,
+                               series + "-catalog.json")
+        self.mtime = None
+        self.episodes = []
+        self.index = {}
+
+    def _scan(self):
+        eps = [x.name for x in os.scandir(self.input_dir)]
+        eps = [x for x in eps if os.path.splitext(x)[1] == ".mp4"]
+        eps = [x[:-4] for x in eps if len(x.split("-")) == 3]
+
+        return sorted(eps)
+
+    def refresh(self):
+        """Rebuild the catalog if the input directory has changed.
+        """
+        mtime = os.stat(self.input_dir).st_mtime
+        if mtime == self.mtime:
+            return
+
+        episodes = None
+        if os.path.isfile(self.cache_path):
+            with open(self.cache_path, "r") as fin:
+                cache = json.load(fin)
+            if cache['mtime'] == mtime and \
+                    cache.get('scanned', mtime) - mtime > MTIME_SLACK:
+                episodes = cache['episodes']
+
+        settled = True
+        if episodes is None:
+            scanned = time.time()
+            episodes = self._scan()
+            settled = scanned - mtime > MTIME_SLACK
+            if settled:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                tmp_path = self.cache_path + ".tmp" + str(os.getpid())
+                with open(tmp_path, "w") as fout:
+                    json.dump({'mtime': mtime, 'scanned': scanned,
+                               'episodes': episodes}, fout)
+                os.replace(tmp_path, self.cache_path)
+
+        # an unsettled listing is scanned again on the next refresh
+        self.mtime = mtime if settled else None
+        self.episodes = episodes
+        self.index = {}
+        for episode in episodes:
+            _, season, number = episode.split("-")
+            self.index.setdefault(season, {})[number] = episode
+
+    def select(self, seasons=(), episodes=()):
+        """Return the sorted episode identifiers matching the selection.
+
+        Args:
+            seasons: season numbers to select; all seasons if empty.
+            episodes: episode numbers to select; all episodes if empty.
+        Returns:
+            a list of episode identifiers.
+        """
+        self.refresh()
+
+        season_names = ["s{0:02d}".format(x) for x in seasons]
+        episode_names = ["e{0:02d}".format(x) for x in episodes]
+        if not seasons:
+            season_names = self.index.keys()
+
+        eps = []
+        for season in season_names:
+            by_episode = self.index.get(season, {})
+            if episodes:
+                eps.extend(by_episode[x] for x in episode_names
+                           if x in by_episode)
+            else:
+                eps.extend(by_episode.values())
+
+        return sorted(eps)
+
+
+def get_catalog(series):
+    """Return the EpisodeCatalog of a series, shared within a process.
+    """
+    key = (get_params_path(), series)
+    if key not in _CATALOGS:
+        _CATALOGS[key] = EpisodeCatalog(series)
 
-    return params
+    return _CATALOGS[key]
 
 
 def get_episodes(args):
@@ -90,20 +500,21 @@ def get_episodes(args):
         raise FileNotFoundError("No video inputs found for series '" +
                                 args.series + "'.")
 
-    eps = os.listdir(join(basepath, "input", args.series))
-    eps = [x for x in eps if os.path.splitext(x)[1] == ".mp4"]
-    eps = [x[:-4] for x in eps if len(x.split("-")) == 3]
-    eps = sorted(eps)
+    return get_catalog(args.series).select(args.season, args.episode)
 
-    if args.season:
-        season_names = ["s{0:02d}".format(x) for x in args.season]
-        eps = [ep for ep in eps if ep.split("-")[1] in season_names]
 
-    if args.episode:
-        episode_names = ["e{0:02d}".format(x) for x in args.episode]
-        eps = [ep for ep in eps if ep.split("-")[2] in episode_names]
+def get_series_paths(series):
+    """Return input, stage and output directories for series id
+    """
+    basepath = read_user_properties()['basepath']
 
-    return eps
+    paths = {
+        'ipath': join(basepath, "input", series),
+        'spath': join(basepath, "stage", series),
+        'opath': join(basepath, "dv-data", series)
+    }
+
+    return paths
 
 
 def get_io_paths(episode):
@@ -122,3 +533,246 @@ def get_io_paths(episode):
     }
 
     return paths
+
+
+def peak_memory_mb():
+    """Return the peak resident memory of this process in megabytes.
+
+    This is the peak since the last call to reset_peak_memory, where the
+    peak can be reset, and since the process started otherwise.
+    """
+    try:
+        with open("/proc/self/status", "r") as fin:
+            match = re.search(r"VmHWM:\s+([0-9]+) kB", fin.read())
+        if match is not None:
+            return int(match.group(1)) / 1024
+    except OSError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak = peak / 1024      # reported in bytes rather than kilobytes
+
+    return peak / 1024
+
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process to its current size.
+
+    Only supported on Linux.
+
+    Returns:
+        True if the peak was reset, otherwise False.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+    except OSError:
+        return False
+
+    return True
+
+
+class EpisodeMetrics():
+    """Collect timings and counters for the stages of one episode.
+
+    Stages with the same name are accumulated, so a stage may be timed
+    once per chunk or once per call. The peak memory is that of the
+    episode where the peak can be reset (on Linux) and that of the whole
+    process otherwise, as given by 'peak_memory_scope'. Episodes run at
+    the same time in threads share one peak, so they are created with
+    'reset_memory' False and always report the process peak.
+    """
+    def __init__(self, episode, reset_memory=True):
+        self.episode = episode
+        self.stages = {}
+        self.memory_scope = "episode" if reset_memory and \
+            reset_peak_memory() else "process"
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name, items=0, bytes_read=0, bytes_written=0):
+        """Time the body of a with statement as a named stage.
+
+        Yields a dictionary of counters that the body may update, for
+        example by setting 'items' once the number of frames is known.
+        """
+        counts = {'items': items, 'bytes_read': bytes_read,
+                  'bytes_written': bytes_written}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            rec = self.stages.setdefault(name, {
+                'calls': 0, 'seconds': 0.0, 'items': 0, 'bytes_read': 0,
+                'bytes_written': 0})
+            rec['calls'] += 1
+            rec['seconds'] += time.perf_counter() - start
+            for key, val in counts.items():
+                rec[key] += val
+
+    def to_dict(self):
+        """Return the metrics as a json serializable dictionary.
+        """
+        stages = {}
+        for name, rec in self.stages.items():
+            stages[name] = dict(rec)
+            if rec['seconds'] > 0 and rec['items']:
+                stages[name]['items_per_sec'] = rec['items'] / rec['seconds']
+
+        return {'episode': self.episode,
+                'seconds': time.perf_counter() - self.start,
+                'peak_memory_mb': peak_memory_mb(),
+                'peak_memory_scope': self.memory_scope,
+                'stages': stages}
+
+
+@contextlib.contextmanager
+def timed(name, items=0, bytes_read=0, bytes_written=0):
+    """Time a stage of the episode being processed by this thread.
+
+    Does nothing (other than yielding a dictionary of counters) when
+    called outside of run_episodes.
+
+    Example:
+        with timed("csv", bytes_written=...) as counts:
+            counts['items'] = len(frame)
+    """
+    metrics = getattr(_METRICS, 'current', None)
+    if metrics is None:
+        yield {'items': items, 'bytes_read': bytes_read,
+               'bytes_written': bytes_written}
+        return
+
+    with metrics.stage(name, items, bytes_read, bytes_written) as counts:
+        yield counts
+
+
+def file_size(path):
+    """Return the size of a file in bytes, or zero if it does not exist.
+    """
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def _call_episode(func, episode, profile_dir=None, reset_memory=True):
+    """Call func on an episode, collecting metrics and any error message.
+    """
+    metrics = EpisodeMetrics(episode, reset_memory)
+    _METRICS.current = metrics
+    profile = cProfile.Profile() if profile_dir else None
+
+    error = None
+    try:
+        if profile is not None:
+            profile.enable()
+        func(episode)
+    except Exception:  # pylint: disable=broad-except
+        error = traceback.format_exc()
+    finally:
+        if profile is not None:
+            profile.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profile.dump_stats(join(profile_dir, episode + ".prof"))
+        _METRICS.current = None
+
+    return error, metrics.to_dict()
+
+
+def _print_metrics_summary(records):
+    """Print a table of the stage timings summed over episodes.
+    """
+    totals = {}
+    for rec in records:
+        for name, stage in rec['stages'].items():
+            total = totals.setdefault(name, dict.fromkeys(
+                ['episodes', 'seconds', 'items', 'bytes_read',
+                 'bytes_written'], 0))
+            total['episodes'] += 1
+            for key in ['seconds', 'items', 'bytes_read', 'bytes_written']:
+                total[key] += stage[key]
+
+    print("{0:<16s} {1:>8s} {2:>10s} {3:>12s} {4:>10s} {5:>10s}".format(
+        "stage", "episodes", "seconds", "items/sec", "MB read", "MB written"))
+    for name, total in totals.items():
+        rate = total['items'] / total['seconds'] if total['seconds'] else 0
+        print("{0:<16s} {1:>8d} {2:>10.2f} {3:>12.1f} {4:>10.1f} {5:>10.1f}"
+              .format(name, total['episodes'], total['seconds'], rate,
+                      total['bytes_read'] / 2**20,
+                      total['bytes_written'] / 2**20))
+    if records:
+        scopes = set(x['peak_memory_scope'] for x in records)
+        print("peak memory: {0:.1f} MB (per {1:s})".format(
+            max(x['peak_memory_mb'] for x in records),
+            "process" if "process" in scopes else "episode"))
+
+
+def run_episodes(func, episodes, jobs=1, verbose=False, threads=False,
+                 metrics=None, profile=None):
+    """Apply a function to each episode, optionally in parallel.
+
+    Failures are isolated per episode: the traceback is printed and the
+    remaining episodes are still processed. Progress is reported in the
+    order the episodes were given, followed by a summary of the run.
+
+    Args:
+        func: callable taking an episode identifier; must be picklable
+            (e.g., a module-level function or functools.partial of one)
+            when jobs is larger than one.
+        episodes: list of episode identifiers. With a single job this may
+            be any iterable, such as a stream of jobs read from a queue.
+        jobs: number of worker processes; one runs in the current process.
+        verbose: Boolean value. Should per-episode progress be printed.
+        threads: Boolean value. Use a pool of threads rather than
+            processes; suitable when the work is done by subprocesses.
+        metrics: optional path of a jsonl file; one line of stage timings
+            is appended per episode and a summary table is printed.
+        profile: optional directory in which to save a cProfile dump of
+            each episode.
+    Returns:
+        list of the episodes that failed.
+    """
+    if jobs > 1:
+        pool = ThreadPoolExecutor if threads else ProcessPoolExecutor
+        executor = pool(max_workers=jobs)
+        # resetting the peak memory in one thread would clear the peak of
+        # the episodes running in the others
+        futures = [(ep, executor.submit(_call_episode, func, ep, profile,
+                                        not threads))
+                   for ep in episodes]
+        results = ((ep, x.result()) for ep, x in futures)
+    else:
+        executor = None
+        results = ((ep, _call_episode(func, ep, profile)) for ep in episodes)
+
+    total = "/" + str(len(episodes)) if hasattr(episodes, '__len__') else ""
+    count = 0
+    failed = []
+    records = []
+    try:
+        for count, (episode, (error, record)) in enumerate(results, start=1):
+            record['status'] = "failed" if error is not None else "ok"
+            record['time'] = iso8601()
+            records.append(record)
+            if metrics is not None:
+                with open(metrics, "a") as fout:
+                    fout.write(json.dumps(record) + "\n")
+
+            if error is not None:
+                failed.append(episode)
+                print('[{0:s}] ({1:d}{2:s}) FAILED --- {3:s}\n{4:s}'.format(
+                    iso8601(), count, total, episode, error))
+            elif verbose:
+                print('[{0:s}] ({1:d}{2:s}) FINISHED --- {3:s}'.format(
+                    iso8601(), count, total, episode))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print('[{0:s}] Processed {1:d} episodes: {2:d} succeeded, {3:d} failed'
+          .format(iso8601(), count, count - len(failed), len(failed)))
+    if failed:
+        print('Failed episodes: ' + ", ".join(failed))
+    if metrics is not None:
+        _print_metrics_summary(records)
+
+    return failed